@@ -1,29 +1,62 @@
 #!/usr/bin/env python
 import argparse
 import os
+import heapq
+import contextlib
+import multiprocessing
+import functools
+import itertools
+from array import array
 
 import pysam
 import numpy as np
 import time
 
 
+# Disjoint set on arrays, find is iterative with path compression and union is by size, group count and total
+# sequence length of each group are updated on each union
 class UnionFind():
-	def __init__(self, size):
-		self.__f = [i for i in range(0, size)]
+	def __init__(self, size, seqLen=None):
+		self.__f = array('q', range(0, size))
+		self.__size = array('q', [1])*size
+		if seqLen is None:
+			self.__len = array('q', [0])*size
+		else:
+			self.__len = array('q', seqLen)
+		self.__groupCount = size
 	
 	
 	def find(self, x):
-		if(self.__f[x] == x):
-			return x
-		self.__f[x] = self.find(self.__f[x])
-		return self.__f[x]
+		f = self.__f
+		root = x
+		while f[root] != root:
+			root = f[root]
+		while f[x] != root:
+			f[x], x = root, f[x]
+		return root
 	
 
+	# return root of merged group
 	def union(self, x, y):
 		fx = self.find(x)
 		fy = self.find(y)
-		if fx != fy:
-			self.__f[fy] = fx
+		if fx == fy:
+			return fx
+		if self.__size[fx] < self.__size[fy]:
+			fx, fy = fy, fx
+		self.__f[fy] = fx
+		self.__size[fx] += self.__size[fy]
+		self.__len[fx] += self.__len[fy]
+		self.__groupCount -= 1
+		return fx
+
+
+	def getGroupCount(self):
+		return self.__groupCount
+
+
+	def getLength(self, x):
+		return self.__len[self.find(x)]
 
 
 def getOpts():
@@ -32,59 +65,413 @@ def getOpts():
 	groups.add_argument('-b', '--bam', help="Prunned bam file", required=True)
 	groups.add_argument('-d', '--bed', help='dup.bed', required=True)
 	groups.add_argument('-a', '--anchors', help='anchors file with dup.mono.anchors', required=True)
-	groups.add_argument('-p', '--poly', help="Ploid count of polyploid", type=int, required=True)
+	groups.add_argument('-p', '--poly', help="Ploid count of polyploid, can be a list separated by comma for sweeping", required=True)
+	groups.add_argument('--ratio', help="Max ratio of the longest group to the shortest one in the longest poly groups, can be a list separated by comma for sweeping, default=3", default="3")
 	groups.add_argument('-e', '--exclude', help="A list file contains exclude contigs for partition, default=\"\"", default="")
+	groups.add_argument('--engine', help="Partition engine, cut: remove edges until groups are balanced, louvain: modularity clustering of contact graph with allelic overlap as cannot-link penalty, default=cut", choices=['cut', 'louvain'], default="cut")
+	groups.add_argument('--resolution', help="Resolution of louvain engine, larger value gives more groups, default=1.0", type=float, default=1.0)
+	groups.add_argument('--penalty', help="Cannot-link penalty of louvain engine, an allelic pair repels with penalty*ovlp*signal, default=1.0", type=float, default=1.0)
 	groups.add_argument('-o', '--out', help="Output directory, default=workdir", default="workdir")
+	groups.add_argument('-t', '--thread', help="Threads for reading bam and sweeping, default=1", type=int, default=1)
 	return groups.parse_args()
 
 
-def getSignal(inBam, seqCount, seqList, qryDB, excludeDB):
+# Read reference ids of read pairs into fixed size chunks
+def readTidChunks(reads, chunkSize=1<<20):
+	tid1 = np.empty(chunkSize, dtype=np.int64)
+	tid2 = np.empty(chunkSize, dtype=np.int64)
+	cnt = 0
+	for line in reads:
+		tid1[cnt] = line.reference_id
+		tid2[cnt] = line.next_reference_id
+		cnt += 1
+		if cnt == chunkSize:
+			yield tid1, tid2
+			cnt = 0
+	if cnt:
+		yield tid1[: cnt], tid2[: cnt]
+
+
+# Merge counted keys of contig pairs, an empty list gives empty counts
+def mergePairCounts(keysList, countsList):
+	if not keysList:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	keys, inverse = np.unique(np.concatenate(keysList), return_inverse=True)
+	counts = np.bincount(inverse, weights=np.concatenate(countsList)).astype(np.int64)
+	return keys, counts
+
+
+# Partial counts of chunks and shards are kept as a stack, the last two are merged while the last one is at least half
+# of the one below it, so sizes in the stack halve from bottom to top, a key is merged about log2(chunks) times
+# and only the contig pairs with links are held
+def addPairCounts(keysList, countsList, keys, counts):
+	keysList.append(keys)
+	countsList.append(counts)
+	while len(keysList) > 1 and len(keysList[-1])*2 >= len(keysList[-2]):
+		keys, counts = mergePairCounts(keysList[-2:], countsList[-2:])
+		keysList[-2:] = [keys]
+		countsList[-2:] = [counts]
+
+
+# Count contig pairs of reads as keys of idx1*seqCount+idx2 with idx1<idx2, refIdx converts reference ids to contig
+# indices
+def countPairs(reads, seqCount, refIdx):
+	keysList = []
+	countsList = []
+	for tid1, tid2 in readTidChunks(reads):
+		idx1 = refIdx[tid1]
+		idx2 = refIdx[tid2]
+		keep = (idx1 != -1) & (idx2 != -1) & (idx1 != idx2)
+		idx1 = idx1[keep]
+		idx2 = idx2[keep]
+		keys, counts = np.unique(np.minimum(idx1, idx2)*seqCount+np.maximum(idx1, idx2), return_counts=True)
+		addPairCounts(keysList, countsList, keys, counts)
+	return mergePairCounts(keysList, countsList)
+
+
+# Shards of bam for counting in parallel, each one holds about 1/(threads*shardPerThread) of mapped reads by index
+# statistics, a large contig is cut into several shards and small contigs share one, large shards go first
+def getShards(inBam, threads, shardPerThread=4):
+	with pysam.AlignmentFile(inBam, 'rb') as fin:
+		ctgStat = sorted([[_.mapped, _.contig] for _ in fin.get_index_statistics() if _.mapped > 0], reverse=True)
+		ctgLenDB = dict(zip(fin.references, fin.lengths))
+	shardSize = max(1, sum([_[0] for _ in ctgStat])//(threads*shardPerThread))
+
+	shards = []
+	batch = []
+	batchSize = 0
+	for mapped, ctg in ctgStat:
+		ctgLen = ctgLenDB[ctg]
+		if mapped > shardSize:
+			regionCount = min(int(np.ceil(mapped*1.0/shardSize)), ctgLen)
+			step = int(np.ceil(ctgLen*1.0/regionCount))
+			for startPos in range(0, ctgLen, step):
+				shards.append([mapped*1.0/regionCount, [[ctg, startPos, min(startPos+step, ctgLen)]]])
+		else:
+			batch.append([ctg, 0, ctgLen])
+			batchSize += mapped
+			if batchSize >= shardSize:
+				shards.append([batchSize, batch])
+				batch = []
+				batchSize = 0
+	if batch:
+		shards.append([batchSize, batch])
+	return [regions for _, regions in sorted(shards, key=lambda x: -x[0])]
+
+
+# Only reads start in region, so a read on the border of two regions is counted once
+def fetchRegion(fin, ctg, startPos, endPos):
+	for line in fin.fetch(contig=ctg, start=startPos, stop=endPos):
+		if line.reference_start >= startPos:
+			yield line
+
+
+def countShard(inBam, seqCount, refIdx, regions):
+	with pysam.AlignmentFile(inBam, 'rb') as fin:
+		reads = itertools.chain.from_iterable(fetchRegion(fin, *region) for region in regions)
+		return countPairs(reads, seqCount, refIdx)
+
+
+# Count contig pairs of whole bam, shards of bam are counted in a process pool and partial counts are merged in
+# parent when threads > 1 and bam is indexed
+def countContigPairs(inBam, seqCount, seqIdx, threads):
+	with pysam.AlignmentFile(inBam, 'rb') as fin:
+		# the last one is for unmapped reads with reference id -1
+		refIdx = np.array([seqIdx.get(ref, -1) for ref in fin.references]+[-1], dtype=np.int64)
+		hasIndex = fin.has_index()
+
+	if threads > 1 and not hasIndex:
+		print("\tNo index of bam file, reading with single thread")
+	if threads <= 1 or not hasIndex:
+		with pysam.AlignmentFile(inBam, 'rb') as fin:
+			return countPairs(fin, seqCount, refIdx)
+
+	shards = getShards(inBam, threads)
+	keysList = []
+	countsList = []
+	partialCountShard = functools.partial(countShard, inBam, seqCount, refIdx)
+	with multiprocessing.Pool(processes=max(min(threads, len(shards)), 1)) as pool:
+		for keys, counts in pool.imap_unordered(partialCountShard, shards):
+			addPairCounts(keysList, countsList, keys, counts)
+	return mergePairCounts(keysList, countsList)
+
+
+# Contig x anchor incidence in CSR format, anchors of contig i are geneList[geneOffset[i]: geneOffset[i+1]], sorted
+# integer ids of reference genes
+def getAnchorIncidence(seqList, qryDB):
+	geneIdx = {}
+	geneOffset = np.zeros(len(seqList)+1, dtype=np.int64)
+	geneList = []
+	for i in range(0, len(seqList)):
+		genes = sorted([geneIdx.setdefault(gene, len(geneIdx)) for gene in qryDB.get(seqList[i], [])])
+		geneList.extend(genes)
+		geneOffset[i+1] = geneOffset[i]+len(genes)
+	return geneOffset, np.array(geneList, dtype=np.int64)
+
+
+# Overlap of anchors of contig pairs, 2*shared/(count1+count2), anchors of the contig with less anchors in each pair are
+# gathered and searched in the sorted incidence keys of the other one, so all pairs are done in bulk
+def getOverlap(idx1, idx2, geneOffset, geneList):
+	geneCount = np.diff(geneOffset)
+	geneTotal = int(geneList.max())+1 if len(geneList) else 1
+	seqIdx = np.repeat(np.arange(len(geneCount)), geneCount)
+	incidenceKeys = seqIdx*geneTotal+geneList
+
+	swap = geneCount[idx1] > geneCount[idx2]
+	smallIdx = np.where(swap, idx2, idx1)
+	largeIdx = np.where(swap, idx1, idx2)
+	repeatCount = geneCount[smallIdx]
+	pairIdx = np.repeat(np.arange(len(smallIdx)), repeatCount)
+	pos = np.arange(len(pairIdx))-np.repeat(np.cumsum(repeatCount)-repeatCount, repeatCount)
+	queryKeys = largeIdx[pairIdx]*geneTotal+geneList[geneOffset[smallIdx][pairIdx]+pos]
+	found = np.searchsorted(incidenceKeys, queryKeys)
+	found[found == len(incidenceKeys)] = 0
+	shared = np.bincount(pairIdx, weights=incidenceKeys[found] == queryKeys, minlength=len(smallIdx))
+
+	total = geneCount[idx1]+geneCount[idx2]
+	ovlp = np.zeros(len(idx1))
+	ovlp[total > 0] = shared[total > 0]*2.0/total[total > 0]
+	return ovlp
+
+
+def getSignal(inBam, seqCount, seqList, qryDB, excludeDB, threads=1):
+	# contigs in excludeDB are not in seqList, so reads on them are skipped as reads on unknown contigs
 	seqIdx = {}
 	for i in range(0, seqCount):
 		seqIdx[seqList[i]] = i
 
-	seqMat = [[0 for i in range(0, seqCount)] for j in range(0, seqCount)]
-	with pysam.AlignmentFile(inBam, 'rb') as fin:
-		for line in fin:
-			ctg1 = line.reference_name
-			ctg2 = line.next_reference_name
-			pos1 = line.reference_start+1
-			pos2 = line.next_reference_start+1
-			if pos1 == -1 or pos2 == -1 or ctg1 == ctg2 or ctg1 in excludeDB or ctg2 in excludeDB:
-				continue
-			idx1 = seqIdx[ctg1]
-			idx2 = seqIdx[ctg2]
-			if idx1>idx2:
-				idx1, idx2 = idx2, idx1
-			seqMat[idx1][idx2] += 1
+	keys, counts = countContigPairs(inBam, seqCount, seqIdx, threads)
+	linked = counts >= 10
+	keys = keys[linked]
+	counts = counts[linked]
+	idx1 = keys//seqCount
+	idx2 = keys%seqCount
+
+	geneOffset, geneList = getAnchorIncidence(seqList, qryDB)
+	ovlpList = getOverlap(idx1, idx2, geneOffset, geneList)
 	
 	sigList = []
-	for idx1 in range(0, seqCount-1):
-		for idx2 in range(idx1+1, seqCount):
-			if seqMat[idx1][idx2] >= 10:
-				ctg1 = seqList[idx1]
-				ctg2 = seqList[idx2]
-				if (ctg1 not in qryDB) or (ctg2 not in qryDB) or (len(qryDB[ctg1])+len(qryDB[ctg2]))==0:
-					ovlp = 0.0
-				else:
-					ovlpCount = len(qryDB[ctg1].intersection(qryDB[ctg2]))
-					ovlp = ovlpCount*2.0/(len(qryDB[ctg1])+len(qryDB[ctg2]))
-				sigList.append([idx1, idx2, seqMat[idx1][idx2], ovlp])
+	for sig in zip(idx1.tolist(), idx2.tolist(), counts.tolist(), ovlpList.tolist()):
+		sigList.append(list(sig))
 	return sigList
 
 
-def checkLongestGroups(lengthList, polyCount):
+# Cut points of edge removal, each cut point removes all edges with the signal of the edge after previous cut point
+def getCutPoints(sigList, i):
+	sigCount = len(sigList)
+	cutList = []
+	while i < sigCount:
+		sig = sigList[i][2]
+		while i < sigCount and sigList[i][2] == sig:
+			i += 1
+		cutList.append(i)
+		i += 1
+	return cutList
+
+
+# Lengths of the longest groups, stale items of heap (merged groups) are dropped when they are met
+def getTopLengths(lengthHeap, uf, topCount):
+	topList = []
+	while lengthHeap and len(topList) < topCount:
+		negLen, gid = heapq.heappop(lengthHeap)
+		if uf.find(gid) == gid and uf.getLength(gid) == -negLen and gid not in [_[1] for _ in topList]:
+			topList.append([negLen, gid])
+	for item in topList:
+		heapq.heappush(lengthHeap, item)
+	return [-_[0] for _ in topList]
+
+
+# Group count and lengths of the longest polyCount groups of each cut point, edges are added into union find in
+# reverse order, so groups only merge and statistics are updated on each union
+def getCutStats(sigList, cutList, seqCount, seqLen, polyCount):
+	uf = UnionFind(seqCount, seqLen)
+	lengthHeap = [[-seqLen[idx], idx] for idx in range(0, seqCount)]
+	heapq.heapify(lengthHeap)
+
+	statList = [None for _ in cutList]
+	pos = len(sigList)
+	for cutIdx in range(len(cutList)-1, -1, -1):
+		while pos > cutList[cutIdx]:
+			pos -= 1
+			idx1, idx2 = sigList[pos][: 2]
+			if uf.find(idx1) != uf.find(idx2):
+				gid = uf.union(idx1, idx2)
+				heapq.heappush(lengthHeap, [-uf.getLength(gid), gid])
+		statList[cutIdx] = [uf.getGroupCount(), getTopLengths(lengthHeap, uf, polyCount)]
+	return statList
+
+
+def checkLongestGroups(lengthList, polyCount, ratio=3):
 	#avgL = np.average(lengthList[: polyCount])
 	minL = min(lengthList[: polyCount])
 	maxL = max(lengthList[: polyCount])
 	print("\tMax %d groups, %s"%(polyCount, ','.join(map(str, lengthList[: polyCount]))))
-	if maxL<=minL*3: #avgL*1.5>maxL and avgL*0.5<minL:
+	if maxL<=minL*ratio: #avgL*1.5>maxL and avgL*0.5<minL:
 		return False
 	else:
 		return True
 
 
-def allHiCPartition(refFasta, inBam, bed, anchors, polyCount, exclude, outDir):
+# Remove edges until there are polyCount groups and the longest polyCount groups are balanced, then write remove.list
+# and group.txt to outDir, i is the count of edges of overlaped contigs, lengths in statList may be more than polyCount
+def cutGroups(sigList, cutList, statList, i, seqCount, seqList, seqLen, polyCount, ratio, outDir):
+	sigCount = len(sigList)
+	currentGroupCount, lengthList = statList[0]
+	lengthList = lengthList[: polyCount]
+
+	cut = 0
+	cutIdx = 0
+	while currentGroupCount < polyCount or checkLongestGroups(lengthList, polyCount, ratio):
+		if cutIdx == len(cutList):
+			print("\tNo more edges could be removed")
+			break
+		cut = cutList[cutIdx]
+		currentGroupCount, lengthList = statList[cutIdx+1]
+		lengthList = lengthList[: polyCount]
+		print("\tCurrent group count: %d, removed edge count: %d"%(currentGroupCount, cut))
+		cutIdx += 1
+		i = cut+1
+	i = min(i, sigCount)
+
+	uf = UnionFind(seqCount, seqLen)
+	for idx in range(cut, sigCount):
+		idx1, idx2, signal, ovlp = sigList[idx]
+		uf.union(idx1, idx2)
+
+	groupDB = {}
+	for idx in range(0, seqCount):
+		gid = uf.find(idx)
+		if gid not in groupDB:
+			groupDB[gid] = []
+		groupDB[gid].append(idx)
+
+
+	with open(os.path.join(outDir, "remove.list"), "w") as fout:
+		for idx in range(0, i):
+			idx1, idx2, signal, ovlp = sigList[idx]
+			fout.write("Remove %d: %s, %s, %d, %f\n"%(idx+1, seqList[idx1], seqList[idx2], signal, ovlp))
+	
+
+	isBalanced = currentGroupCount >= polyCount and not checkLongestGroups(lengthList, polyCount, ratio)
+	lengthDB = {}
+	for gid in groupDB:
+		lengthDB[gid] = uf.getLength(gid)
+	writeGroups(groupDB, lengthDB, seqList, outDir)
+
+	return [currentGroupCount, cut, isBalanced, lengthList]
+
+
+# Write groups sorted by length
+def writeGroups(groupDB, lengthDB, seqList, outDir):
+	groupList = []
+	for gid in groupDB:
+		groupList.append([gid, lengthDB[gid]])
+
+	groupList = sorted(groupList, key=lambda x: -x[1])
+
+	print("Writing group list")
+	with open(os.path.join(outDir, "group.txt"), "w") as fout:
+		for i in range(0, len(groupList)):
+			idx = groupList[i][0]
+			fout.write("group%d\t"%(i+1))
+			tmp = []
+			for subIdx in sorted(groupDB[idx]):
+				tmp.append(seqList[subIdx])
+			fout.write("%s\n"%'\t'.join(tmp))
+
+
+# One level of louvain, all nodes choose their best community at the same time, and a random half of nodes which
+# gain modularity move in each round to avoid swapping, posW and negW are weights of contacts and cannot-links, both
+# edge lists contain each edge in two directions without self loops
+def louvainMove(nodeCount, src, dst, posW, negW, degree, totalW, resolution, randState, maxRound=100):
+	comm = np.arange(nodeCount)
+	weight = posW-negW
+	for _ in range(0, maxRound):
+		commW = np.bincount(comm, weights=degree, minlength=nodeCount)
+		keys, inverse = np.unique(src*nodeCount+comm[dst], return_inverse=True)
+		linkW = np.bincount(inverse, weights=weight)
+		node = keys//nodeCount
+		target = keys%nodeCount
+		isOwn = target == comm[node]
+		gain = linkW-resolution*degree[node]*(commW[target]-np.where(isOwn, degree[node], 0))/totalW
+
+		# gain of staying is the gain of own community, 0 links if node has no link to it
+		stayGain = -resolution*degree*(commW[comm]-degree)/totalW
+		stayGain[node[isOwn]] = gain[isOwn]
+		order = np.lexsort((-gain, node))
+		first = np.ones(len(order), dtype=bool)
+		first[1:] = node[order][1:] != node[order][:-1]
+		best = order[first]
+		candidate = (gain[best] > stayGain[node[best]]+1e-12) & ~isOwn[best]
+		if not candidate.any():
+			break
+		move = candidate & (randState.random_sample(len(best)) < 0.5)
+		comm[node[best][move]] = target[best][move]
+	return np.unique(comm, return_inverse=True)[1]
+
+
+# Merge nodes of same community into one node, weights between communities are summed and self loops are dropped
+def louvainAggregate(comm, commCount, src, dst, posW, negW):
+	keys = comm[src]*commCount+comm[dst]
+	keep = comm[src] != comm[dst]
+	keys, inverse = np.unique(keys[keep], return_inverse=True)
+	posW = np.bincount(inverse, weights=posW[keep])
+	negW = np.bincount(inverse, weights=negW[keep])
+	return keys//commCount, keys%commCount, posW, negW
+
+
+# Louvain clustering of contigs, signals of pairs without allelic overlap are contacts and pairs with overlap are
+# cannot-links with weight penalty*ovlp*signal, levels are repeated until no nodes are merged
+def louvainCluster(sigList, seqCount, resolution, penalty, seed=0):
+	sigArr = np.array([sig[: 4] for sig in sigList], dtype=np.float64).reshape(-1, 4)
+	idx1 = sigArr[:, 0].astype(np.int64)
+	idx2 = sigArr[:, 1].astype(np.int64)
+	isAllelic = sigArr[:, 3] > 0
+	posW = np.where(isAllelic, 0, sigArr[:, 2])
+	negW = np.where(isAllelic, penalty*sigArr[:, 3]*sigArr[:, 2], 0)
+	src = np.concatenate([idx1, idx2])
+	dst = np.concatenate([idx2, idx1])
+	posW = np.concatenate([posW, posW])
+	negW = np.concatenate([negW, negW])
+	degree = np.bincount(src, weights=posW, minlength=seqCount)
+	totalW = max(degree.sum(), 1)
+
+	randState = np.random.RandomState(seed)
+	seqComm = np.arange(seqCount)
+	nodeCount = seqCount
+	while True:
+		comm = louvainMove(nodeCount, src, dst, posW, negW, degree, totalW, resolution, randState)
+		commCount = int(comm.max())+1 if nodeCount else 0
+		print("\tLevel with %d nodes, %d groups"%(nodeCount, commCount))
+		if commCount == nodeCount:
+			break
+		seqComm = comm[seqComm]
+		src, dst, posW, negW = louvainAggregate(comm, commCount, src, dst, posW, negW)
+		degree = np.bincount(comm, weights=degree, minlength=commCount)
+		nodeCount = commCount
+	return seqComm
+
+
+def initSweep(sigList, cutList, statList, i, seqCount, seqList, seqLen):
+	global sweepData
+	sweepData = [sigList, cutList, statList, i, seqCount, seqList, seqLen]
+
+
+# Cut groups with one setting of sweep in its sub directory, messages are written to partition.log in it
+def runSweep(job):
+	polyCount, ratio, subDir = job
+	if not os.path.exists(subDir):
+		os.mkdir(subDir)
+	sigList, cutList, statList, i, seqCount, seqList, seqLen = sweepData
+	with open(os.path.join(subDir, "partition.log"), 'w') as fout:
+		with contextlib.redirect_stdout(fout):
+			return cutGroups(sigList, cutList, statList, i, seqCount, seqList, seqLen, polyCount, float(ratio), subDir)
+
+
+def allHiCPartition(refFasta, inBam, bed, anchors, poly, ratio, exclude, outDir, threads, engine, resolution, penalty):
+	polyList = [int(_) for _ in poly.split(',')]
+	ratioList = ratio.split(',')
+
 	# Get full file path
 	refFasta = os.path.abspath(refFasta)
 	inBam = os.path.abspath(inBam)
@@ -151,7 +538,7 @@ def allHiCPartition(refFasta, inBam, bed, anchors, polyCount, exclude, outDir):
 	for i in range(0, seqCount):
 		seqLen.append(len(faDB[seqList[i]]))
 
-	sigList = getSignal(inBam, seqCount, seqList, qryDB, excludeDB)
+	sigList = getSignal(inBam, seqCount, seqList, qryDB, excludeDB, threads)
 	
 	# Save signal list
 	print("Saving signal list")
@@ -159,107 +546,69 @@ def allHiCPartition(refFasta, inBam, bed, anchors, polyCount, exclude, outDir):
 		for idx1, idx2, signal, ovlp in sigList:
 			fout.write("%s\t%s\t%d\t%f\n"%(seqList[idx1], seqList[idx2], signal, ovlp))
 	
+	if engine == 'louvain':
+		print("Clustering with louvain")
+		seqComm = louvainCluster(sigList, seqCount, resolution, penalty)
+		groupDB = {}
+		lengthDB = {}
+		for idx in range(0, seqCount):
+			gid = seqComm[idx]
+			if gid not in groupDB:
+				groupDB[gid] = []
+				lengthDB[gid] = 0
+			groupDB[gid].append(idx)
+			lengthDB[gid] += seqLen[idx]
+		print("\tGroup count: %d"%len(groupDB))
+		checkLongestGroups(sorted(lengthDB.values(), reverse=True), polyList[0], float(ratioList[0]))
+
+		# edges between groups are removed
+		with open("remove.list", "w") as fout:
+			removeCount = 0
+			for idx1, idx2, signal, ovlp in sigList:
+				if seqComm[idx1] != seqComm[idx2]:
+					removeCount += 1
+					fout.write("Remove %d: %s, %s, %d, %f\n"%(removeCount, seqList[idx1], seqList[idx2], signal, ovlp))
+		writeGroups(groupDB, lengthDB, seqList, outDir)
+		print("Finished")
+		return
+
 	# Initial UnionFind
 	sigList = sorted(sigList, key=lambda x: (-x[3], x[2]))
 	sigCount = len(sigList)
 	print("Generating Union find")
-	uf = UnionFind(seqCount)
-	for idx1, idx2, signal, ovlp in sigList:
-		uf.union(idx1, idx2)
-	
-	# Get current groups
-	currentGroupCount = 0
-	for idx in range(0, seqCount):
-		if uf.find(idx) == idx:
-			currentGroupCount += 1
-	
-	print("\tInitial group count: %d, edge count: %d"%(currentGroupCount, sigCount))
-
-	groupDB = {}
-	for idx in range(0, seqCount):
-		gid = uf.find(idx)
-		if gid not in groupDB:
-			groupDB[gid] = []
-		groupDB[gid].append(idx)	
-	
-	lengthList = []
-	for gid in groupDB:
-		curLen = 0
-		for idx in groupDB[gid]:
-			curLen += seqLen[idx]
-		lengthList.append(curLen)
-	lengthList = sorted(lengthList, reverse=True)
-
 	i = 1
 	while sigList[i][3] > 0:
 		i += 1
 
-	print("\tRemoved: %d edges while contigs were overlaped"%i)
-
-	while currentGroupCount < polyCount or checkLongestGroups(lengthList, polyCount):
-		sig = sigList[i][2]
-		while sigList[i][2] == sig:
-			i += 1
-		
-		uf = UnionFind(seqCount)
-		for idx in range(i, sigCount):
-			idx1, idx2, signal, ovlp = sigList[idx]
-			uf.union(idx1, idx2)
-		
-		lengthList = []
-		currentGroupCount = 0
-		for idx in range(0, seqCount):
-			if uf.find(idx) == idx:
-				currentGroupCount += 1
-
-		groupDB = {}
-		for idx in range(0, seqCount):
-			gid = uf.find(idx)
-			if gid not in groupDB:
-				groupDB[gid] = []
-			groupDB[gid].append(idx)	
-		
-		lengthList = []
-		for gid in groupDB:
-			curLen = 0
-			for idx in groupDB[gid]:
-				curLen += seqLen[idx]
-			lengthList.append(curLen)
-		lengthList = sorted(lengthList, reverse=True)
-
-		print("\tCurrent group count: %d, removed edge count: %d"%(currentGroupCount, i))
-		i += 1
-
-
-	with open("remove.list", "w") as fout:
-		for idx in range(0, i):
-			idx1, idx2, signal, ovlp = sigList[idx]
-			fout.write("Remove %d: %s, %s, %d, %f\n"%(idx+1, seqList[idx1], seqList[idx2], signal, ovlp))
-	
-
-	checkLongestGroups(lengthList, polyCount)
-	lengthDB = {}
-	for gid in groupDB:
-		curLen = 0
-		for idx in groupDB[gid]:
-			curLen += seqLen[idx]
-		lengthDB[gid] = curLen
-
-	groupList = []
-	for gid in groupDB:
-		groupList.append([gid, lengthDB[gid]])
+	# Edges before a cut point are removed, the group count and lengths of all cut points are got in one pass
+	cutList = getCutPoints(sigList, i)
+	statList = getCutStats(sigList, [0]+cutList, seqCount, seqLen, max(polyList))
+	currentGroupCount, lengthList = statList[0]
+	print("\tInitial group count: %d, edge count: %d"%(currentGroupCount, sigCount))
 
-	groupList = sorted(groupList, key=lambda x: -x[1])
+	print("\tRemoved: %d edges while contigs were overlaped"%i)
 
-	print("Writing group list")
-	with open("group.txt", "w") as fout:
-		for i in range(0, len(groupList)):
-			idx = groupList[i][0]
-			fout.write("group%d\t"%(i+1))
-			tmp = []
-			for subIdx in sorted(groupDB[idx]):
-				tmp.append(seqList[subIdx])
-			fout.write("%s\n"%'\t'.join(tmp))
+	if len(polyList) == 1 and len(ratioList) == 1:
+		cutGroups(sigList, cutList, statList, i, seqCount, seqList, seqLen, polyList[0], float(ratioList[0]), outDir)
+	else:
+		# the signal graph and statistics of cut points are shared by all settings
+		print("Sweeping %d settings"%(len(polyList)*len(ratioList)))
+		jobs = []
+		for polyCount in polyList:
+			for ratio in ratioList:
+				jobs.append([polyCount, ratio, "poly%d_ratio%s"%(polyCount, ratio)])
+		# workers are forked so the signal list is shared with them instead of being pickled into each of them
+		with multiprocessing.get_context('fork').Pool(processes=max(min(threads, len(jobs)), 1), initializer=initSweep,
+													  initargs=(sigList, cutList, statList, i, seqCount, seqList, seqLen)) as pool:
+			resultList = pool.map(runSweep, jobs)
+
+		print("Writing sweep summary")
+		with open("sweep.txt", "w") as fout:
+			fout.write("#Poly\tRatio\tGroups\tRemoved edges\tBalanced\tLongest groups\tDirectory\n")
+			for job, result in zip(jobs, resultList):
+				polyCount, ratio, subDir = job
+				currentGroupCount, cut, isBalanced, lengthList = result
+				fout.write("%d\t%s\t%d\t%d\t%s\t%s\t%s\n"%(polyCount, ratio, currentGroupCount, cut, "yes" if isBalanced else "no", ','.join(map(str, lengthList)), subDir))
 
 	print("Finished")
 
@@ -270,7 +619,12 @@ if __name__ == "__main__":
 	inBam = opts.bam
 	bed = opts.bed
 	anchors = opts.anchors
-	polyCount = opts.poly
+	poly = opts.poly
+	ratio = opts.ratio
 	exclude = opts.exclude
 	outDir = opts.out
-	allHiCPartition(refFasta, inBam, bed, anchors, polyCount, exclude, outDir)
+	threads = opts.thread
+	engine = opts.engine
+	resolution = opts.resolution
+	penalty = opts.penalty
+	allHiCPartition(refFasta, inBam, bed, anchors, poly, ratio, exclude, outDir, threads, engine, resolution, penalty)
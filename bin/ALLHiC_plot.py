@@ -4,12 +4,17 @@ import numpy as np
 import h5py
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from PIL import Image
 import multiprocessing
-import ctypes
 import functools
+import itertools
+import collections
+import gzip
 import pysam
+import hashlib
 import time
 import os
+import sys
 
 mpl.use("Agg")
 
@@ -20,7 +25,9 @@ def time_print(info):
 
 def get_opts():
     groups = argparse.ArgumentParser()
-    groups.add_argument('-b', '--bam', help='Input bam file', required=True)
+    groups.add_argument('-b', '--bam', help='Input bam file or pairs file (4DN pairs or juicer short format, can be '
+                                            'gzipped, "-" for stdin), can be a list separated by comma, the read '
+                                            'counts of them are added together', required=True)
     groups.add_argument('-l', '--list', help='Chromosome list, contain: ID\tLength', required=True)
     groups.add_argument('-a', '--agp', help='Input AGP file, if bam file is a contig-level mapping, agp file is '
                                             'required', default="")
@@ -28,18 +35,42 @@ def get_opts():
                         help="h5 file of hic signal, optional, if not exist, it will be generate after reading "
                              "hic signals, or it will be loaded for drawing other resolution of heatmap",
                         default="")
+    groups.add_argument('--append', help='Add read counts of bam files to existing h5 file, chromosomes, agp and '
+                                         'min_size must be same with it, bam files already in it are skipped',
+                        action='store_true')
+    groups.add_argument('-r', '--region', help='Chromosomes to plot, separated by comma, only reads on them (or on '
+                                               'their contigs with agp) are loaded, default: all chromosomes in list',
+                        default="")
+    groups.add_argument('--preview', help='Only read a part of bam files for a quick look, a fraction of reads (<1) or '
+                                          'a number of reads on each reference (>=1), default=0 (all reads)',
+                        type=float, default=0)
+    groups.add_argument('--refine', help='Keep reading after preview, the read fraction is doubled in each round and '
+                                         'heatmaps and h5 file are rewritten until all reads are read',
+                        action='store_true')
     groups.add_argument('-m', '--min_size', help="Minium bin size of heatmap, default=50k", default="50k")
     groups.add_argument('-s', '--size',
-                        help="Bin size of heatmap, can be a list separated by comma, default=500k, notice: it must "
-                             "be n times of min_size (n is integer) or we will adjust it to nearest one",
+                        help="Bin size of heatmap, can be a list separated by comma, or auto to choose them by "
+                             "pixels, default=500k, notice: it must be n times of min_size (n is integer) or we will "
+                             "adjust it to nearest one",
                         default="500k")
+    groups.add_argument('--pixels', help='Pixel budget of auto bin size, the smallest bin size whose heatmap fits it '
+                                         'is used for whole genome heatmap and each chromosome subplot, '
+                                         'default=1000,400', default="1000,400")
+    groups.add_argument('--balance', help='Balance matrices by iterative correction (ICE) before drawing, weights of '
+                                          'bins are stored in h5 file', action='store_true')
     groups.add_argument('-c', '--cmap', help='CMAP for drawing heatmap, default="YlOrRd"', default='YlOrRd')
     groups.add_argument('-o', '--outdir', help='Output directory, default=workdir', default='workdir')
     groups_ex = groups.add_mutually_exclusive_group()
     groups_ex.add_argument('--line', help='Draw dash line for each chromosome', action='store_true')
     groups_ex.add_argument('--block', help='Draw dash block for each chromosome', action='store_true')
     groups.add_argument('--linecolor', help='Color of dash line or dash block, default="grey"', default='grey')
-    groups.add_argument('-t', '--thread', help='Threads for reading bam, default=1', type=int, default=1)
+    groups.add_argument('--raster', help='Write whole genome heatmap as raster image directly instead of pdf, faster '
+                                         'and smaller for large matrices, default=""', choices=['png', 'tiff'],
+                        default="")
+    groups.add_argument('--frame', help='Write a small pdf with labels and thumbnail for raster heatmap',
+                        action='store_true')
+    groups.add_argument('-t', '--thread', help='Threads for reading bam and drawing heatmap, default=1', type=int,
+                        default=1)
     return groups.parse_args()
 
 
@@ -64,8 +95,9 @@ def short2long(bin_size: str) -> int:
     return long_bin_size
 
 
-# Get chromosome length
-def get_chr_len(chr_list):
+# Get chromosome length, if region is set, only chromosomes in it are kept with the order in chromosome list
+def get_chr_len(chr_list, region=""):
+    chr_subset = set(region.split(',')) if region else None
     chr_len_db = {}
     chr_order = []
     with open(chr_list, 'r') as f_in:
@@ -73,20 +105,346 @@ def get_chr_len(chr_list):
             if line.strip() == '':
                 continue
             data = line.strip().split()
+            if chr_subset is not None and data[0] not in chr_subset:
+                continue
             chr_order.append(data[0])
             chr_len_db[data[0]] = int(data[1])
     return chr_len_db, chr_order
 
 
-# Init global shared array
-def init_pool(bin_offset, read_count_whole_genome):
-    global shared_bin_offset
-    shared_bin_offset = bin_offset
-    global shared_read_count_whole_genome
-    shared_read_count_whole_genome = read_count_whole_genome
+# Init global shared liftover
+def init_pool(liftover):
+    global shared_liftover
+    shared_liftover = liftover
+
+
+# Upper triangle of symmetric read count matrix, stored as CSR with integer counts, the full matrix is M + M.T
+class SparseMatrix:
+    def __init__(self, size, indptr, indices, data):
+        self.size = size
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    # keys are row * size + col with row <= col, sorted and unique
+    @classmethod
+    def from_keys(cls, keys, counts, size):
+        rows = keys // size
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+        indices = (keys - rows * size).astype(np.int32)
+        return cls(size, indptr, indices, counts.astype(np.int32))
+
+    # convert dense symmetric matrix (old h5 file) to sparse, row block by row block
+    @classmethod
+    def from_dense(cls, dense, block_size=1024):
+        size = len(dense)
+        keys_list = []
+        counts_list = []
+        for sr in range(0, size, block_size):
+            er = min(sr + block_size, size)
+            block = np.triu(np.asarray(dense[sr: er], dtype=np.float64), k=sr)
+            block[np.arange(er - sr), np.arange(sr, er)] /= 2
+            rows, cols = np.nonzero(block)
+            keys_list.append((rows + sr).astype(np.int64) * size + cols)
+            counts_list.append(np.round(block[rows, cols]).astype(np.int64))
+        return cls.from_keys(np.concatenate(keys_list), np.concatenate(counts_list), size)
+
+    # sum read counts of matrices with same size, such as matrices of different bam files
+    @classmethod
+    def merge(cls, matrices):
+        size = matrices[0].size
+        keys_list = []
+        counts_list = []
+        for matrix in matrices:
+            rows, cols, counts = matrix.get_rows(0, size)
+            keys_list.append(rows * size + cols)
+            counts_list.append(np.asarray(counts))
+        keys, counts = merge_bin_pairs(keys_list, counts_list)
+        return cls.from_keys(keys, counts, size)
+
+    # rows in [start, end) as coo, indices and data can be datasets of h5 file
+    def get_rows(self, start, end):
+        indptr = self.indptr[start: end + 1]
+        rows = np.repeat(np.arange(start, end, dtype=np.int64), np.diff(indptr))
+        return rows, self.indices[int(indptr[0]): int(indptr[-1])], self.data[int(indptr[0]): int(indptr[-1])]
+
+    # sum bins of each chromosome by ratio, return new matrix and bin offsets of chromosomes on it
+    def coarsen(self, bin_offset, ratio):
+        if ratio == 1:
+            return self, bin_offset
+        level = LevelMatrix(self, bin_offset, ratio)
+        rows = level.bin_map[np.repeat(np.arange(self.size), np.diff(self.indptr))]
+        cols = level.bin_map[self.indices]
+        keys, counts = merge_bin_pairs([rows * level.size + cols], [self.data])
+        return SparseMatrix.from_keys(keys, counts, level.size), level.bin_offset
+
+
+# Level of ratio summed from a sparse matrix on the fly, bins of a chromosome start from its first bin like cool
+# files, rows of the sparse matrix are read block by block, so a matrix in h5 file is never loaded at once, if weight
+# of bins of the sparse matrix is set, balanced read counts are summed
+class LevelMatrix:
+    def __init__(self, matrix, bin_offset, ratio, weight=None):
+        bin_count = np.diff(bin_offset)
+        self.bin_offset = np.zeros(len(bin_offset), dtype=np.int64)
+        np.cumsum((bin_count + ratio - 1) // ratio, out=self.bin_offset[1:])
+        self.size = int(self.bin_offset[-1])
+        chr_idx = np.repeat(np.arange(len(bin_count)), bin_count)
+        self.bin_map = self.bin_offset[chr_idx] + (np.arange(matrix.size) - bin_offset[chr_idx]) // ratio
+        self.matrix = matrix
+        self.weight = weight
+
+    # read counts of upper triangle of bins in [start, end) as coo relative to start, row block by row block, blocks
+    # end at the boundary of bins of this level, so each pair of bins is summed completely in one block
+    def iter_sums(self, start=0, end=None, block_nnz=1 << 22):
+        if end is None:
+            end = self.size
+        cnt = end - start
+        row_start, row_end = np.searchsorted(self.bin_map, [start, end])
+        indptr = self.matrix.indptr
+        sr = row_start
+        while sr < row_end:
+            er = np.searchsorted(indptr, indptr[sr] + block_nnz, side='right') - 1
+            er = min(max(er, sr + 1), row_end)
+            er = min(np.searchsorted(self.bin_map, self.bin_map[er - 1] + 1), row_end)
+            rows, cols, counts = self.matrix.get_rows(sr, er)
+            if self.weight is not None:
+                counts = counts * self.weight[rows] * self.weight[cols]
+            keep = cols < row_end
+            keys, inverse = np.unique((self.bin_map[rows[keep]] - start) * cnt + self.bin_map[cols[keep]] - start,
+                                      return_inverse=True)
+            yield keys // cnt, keys % cnt, np.bincount(inverse, weights=counts[keep])
+            sr = er
+
+    # read counts of bins in [start, end), return dense symmetric matrix, each summed pair is added to both sides of
+    # diagonal in place, so the memory is the returned matrix and one row block
+    def bin_sum(self, start=0, end=None, block_nnz=1 << 22):
+        if end is None:
+            end = self.size
+        cnt = end - start
+        data = np.zeros(cnt * cnt)
+        for rows, cols, sums in self.iter_sums(start, end, block_nnz):
+            # pairs on diagonal are added twice like the sum of matrix and its transpose
+            data[rows * cnt + cols] += sums
+            data[cols * cnt + rows] += sums
+        return data.reshape(cnt, cnt)
+
+
+# Convert bin pairs to upper triangle keys and count them
+def count_bin_pairs(whole_pos1, whole_pos2, total_bin_count):
+    whole_pos1 = np.asarray(whole_pos1, dtype=np.int64)
+    whole_pos2 = np.asarray(whole_pos2, dtype=np.int64)
+    keys = np.minimum(whole_pos1, whole_pos2) * total_bin_count + np.maximum(whole_pos1, whole_pos2)
+    return np.unique(keys, return_counts=True)
+
+
+# Merge counted keys
+def merge_bin_pairs(keys_list, counts_list):
+    keys, inverse = np.unique(np.concatenate(keys_list), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts_list)).astype(np.int64)
+    return keys, counts
+
+
+# Private accumulator of counted bin pairs, partial results are merged like a binary counter (a result is merged
+# into the previous one once it is not smaller than half of it), so each key is merged O(log n) times and the
+# memory stays close to the non-zero bins
+class BinPairCounter:
+    def __init__(self):
+        self.keys_list = []
+        self.counts_list = []
+
+    def add(self, keys, counts):
+        self.keys_list.append(keys)
+        self.counts_list.append(counts)
+        while len(self.keys_list) > 1 and len(self.keys_list[-1]) * 2 >= len(self.keys_list[-2]):
+            keys, counts = merge_bin_pairs(self.keys_list[-2:], self.counts_list[-2:])
+            self.keys_list[-2:] = [keys]
+            self.counts_list[-2:] = [counts]
+
+    def result(self):
+        if not self.keys_list:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return merge_bin_pairs(self.keys_list, self.counts_list)
+
+
+def save_matrix(h5, name, matrix):
+    grp = h5.create_group(name)
+    grp.attrs['size'] = matrix.size
+    grp.create_dataset('indptr', data=matrix.indptr, chunks=True, compression='gzip')
+    grp.create_dataset('indices', data=matrix.indices, chunks=True, compression='gzip')
+    grp.create_dataset('data', data=matrix.data, chunks=True, compression='gzip')
+    return grp
+
+
+# indices and data are kept in h5 file and read when needed
+def load_matrix(h5, name):
+    grp = h5[name]
+    return SparseMatrix(int(grp.attrs['size']), grp['indptr'][:], grp['indices'], grp['data'])
+
+
+# Iterative correction of a sparse matrix, the diagonal is ignored, bins with few reads (log of row sum less than
+# median - mad_max * MAD) are masked with weight 0, weight is 1 / bias like cool files, so balanced read count of bin
+# i and bin j is count * weight[i] * weight[j]
+def ice_balance(matrix, max_iter=200, tol=1e-5, mad_max=5):
+    rows, cols, counts = matrix.get_rows(0, matrix.size)
+    keep = rows != cols
+    rows = rows[keep]
+    cols = np.asarray(cols)[keep]
+    counts = np.asarray(counts, dtype=np.float64)[keep]
+    marginal = np.bincount(rows, weights=counts, minlength=matrix.size) + \
+        np.bincount(cols, weights=counts, minlength=matrix.size)
+    mask = marginal > 0
+    if not mask.any():
+        return mask.astype(np.float64)
+    log_marginal = np.log(marginal[mask])
+    median = np.median(log_marginal)
+    mask[mask] = log_marginal >= median - mad_max * np.median(np.abs(log_marginal - median))
+    weight = mask.astype(np.float64)
+    for _ in range(max_iter):
+        balanced = counts * weight[rows] * weight[cols]
+        marginal = np.bincount(rows, weights=balanced, minlength=matrix.size) + \
+            np.bincount(cols, weights=balanced, minlength=matrix.size)
+        scale = marginal[mask] / marginal[mask].mean()
+        scale[scale == 0] = 1
+        weight[mask] /= scale
+        if scale.var() < tol:
+            break
+    return weight
+
+
+# Levels of 1-2-5 series of min_size and the bin sizes for drawing, stop when the whole genome has less than
+# 100 bins
+def get_pyramid_ratios(total_bin_count, bin_ratio):
+    ratios = set(bin_ratio)
+    scale = 1
+    while True:
+        for step in [2, 5, 10]:
+            if total_bin_count < step * scale * 100:
+                return sorted(ratios - {1})
+            ratios.add(step * scale)
+        scale *= 10
+
+
+# Read count matrix in multiple resolutions, level n contains bins of n times of min_size, level 1 is the matrix
+# with min_size, levels are stored in the pyramid group of h5 file, missing levels are summed from the nearest
+# stored level which can divide it
+class MatrixPyramid:
+    def __init__(self, bin_offset_min_size, matrix=None, h5=None):
+        self.levels = {}
+        self.weights = {}
+        self.h5 = h5
+        if matrix is not None:
+            self.levels[1] = (matrix, bin_offset_min_size)
+        self.bin_offset_min_size = bin_offset_min_size
+
+    def stored_ratios(self):
+        ratios = set(self.levels)
+        if self.h5 is not None:
+            ratios.add(1)
+            if 'pyramid' in self.h5:
+                ratios.update([int(_) for _ in self.h5['pyramid']])
+        return ratios
+
+    @staticmethod
+    def level_name(ratio):
+        if ratio == 1:
+            return 'read_count_whole_genome_min_size_sparse'
+        return 'pyramid/%d' % ratio
 
+    def load(self, ratio):
+        if ratio in self.levels:
+            return self.levels[ratio]
+        if ratio == 1:
+            return load_matrix(self.h5, self.level_name(ratio)), self.bin_offset_min_size
+        name = self.level_name(ratio)
+        return load_matrix(self.h5, name), self.h5[name]['bin_offset'][:]
 
-# agp reader
+    def load_weight(self, ratio):
+        if ratio in self.weights:
+            return self.weights[ratio]
+        return self.h5[self.level_name(ratio)]['weight'][:]
+
+    # with balance, a bin size not in pyramid is the sum of balanced bins of the level it is summed from
+    def get(self, ratio, balance=False):
+        base_ratio = max([_ for _ in self.stored_ratios() if ratio % _ == 0])
+        matrix, bin_offset = self.load(base_ratio)
+        weight = self.load_weight(base_ratio) if balance else None
+        return LevelMatrix(matrix, bin_offset, ratio // base_ratio, weight)
+
+    # balance each level separately, levels with weight in h5 file are skipped
+    def balance(self):
+        for ratio in sorted(self.stored_ratios()):
+            if ratio in self.weights or (ratio not in self.levels and 'weight' in self.h5[self.level_name(ratio)]):
+                continue
+            self.weights[ratio] = ice_balance(self.load(ratio)[0])
+
+    # write weights of levels which are stored in h5 file
+    def save_weights(self, h5):
+        for ratio in sorted(self.weights):
+            name = self.level_name(ratio)
+            if name not in h5:
+                continue
+            if 'weight' in h5[name]:
+                del h5[name]['weight']
+            h5[name].create_dataset('weight', data=self.weights[ratio])
+
+    def build(self, ratios):
+        for ratio in sorted(ratios):
+            base_ratio = max([_ for _ in self.levels if ratio % _ == 0])
+            matrix, bin_offset = self.levels[base_ratio]
+            self.levels[ratio] = matrix.coarsen(bin_offset, ratio // base_ratio)
+
+    def save(self, h5):
+        h5.create_dataset('bin_offset_min_size', data=self.bin_offset_min_size)
+        save_matrix(h5, self.level_name(1), self.levels[1][0])
+        for ratio in sorted(self.levels):
+            if ratio == 1:
+                continue
+            matrix, bin_offset = self.levels[ratio]
+            grp = save_matrix(h5, self.level_name(ratio), matrix)
+            grp.create_dataset('bin_offset', data=bin_offset)
+
+
+# Inputs recorded in h5 file, bams are absolute paths of bam or pairs files which have been added, stdin is not
+# recorded
+def get_h5_info(chr_order, agp, min_size, bams):
+    agp_md5 = ""
+    if agp:
+        with open(agp, 'rb') as fin:
+            agp_md5 = hashlib.md5(fin.read()).hexdigest()
+    return {'chr_order': chr_order, 'agp_md5': agp_md5, 'min_size': min_size, 'bams': [_ for _ in bams if _ != '-']}
+
+
+# Check inputs of h5 file, old h5 files only have bin offsets, so chromosomes are checked by count of them
+def check_h5_info(h5_data, h5_info):
+    if 'chr_order' in h5_data.attrs:
+        h5_chr_order = [str(_) for _ in h5_data.attrs['chr_order']]
+    elif len(h5_data['bin_offset_min_size']) == len(h5_info['chr_order']) + 1:
+        h5_chr_order = h5_info['chr_order']
+    else:
+        h5_chr_order = []
+    if h5_chr_order != h5_info['chr_order']:
+        time_print("Fatal: chromosomes in h5 file are different with chromosome list and region")
+        sys.exit(-1)
+    for key, name in [['agp_md5', 'agp'], ['min_size', 'min_size']]:
+        if key in h5_data.attrs and h5_data.attrs[key] != h5_info[key]:
+            time_print("Fatal: %s of h5 file is different with input" % name)
+            sys.exit(-1)
+
+
+# Build pyramid and write h5 file, it is written to a temporary file first, so the old one is kept if it fails
+def save_h5(h5_file, pyramid, bin_ratio, h5_info):
+    time_print("Building pyramid")
+    pyramid.build(get_pyramid_ratios(pyramid.levels[1][0].size, bin_ratio))
+    tmp_file = h5_file + '.tmp'
+    with h5py.File(tmp_file, 'w') as h5:
+        pyramid.save(h5)
+        for key in h5_info:
+            h5.attrs[key] = h5_info[key]
+    os.replace(tmp_file, h5_file)
+
+
+# agp reader, a contig may be broken into several pieces
 def load_agp(agp):
     ctg_on_chr = {}
     with open(agp, 'r') as f_in:
@@ -100,92 +458,268 @@ def load_agp(agp):
             start_pos = int(data[1])
             end_pos = int(data[2])
             ctg = data[5].replace('_pilon', '')
+            ctg_start_pos = int(data[6])
+            ctg_end_pos = int(data[7])
             direct = data[-1]
-            ctg_on_chr[ctg] = [chrn, start_pos, end_pos, direct]
+            if ctg not in ctg_on_chr:
+                ctg_on_chr[ctg] = []
+            ctg_on_chr[ctg].append([chrn, start_pos, end_pos, direct, ctg_start_pos, ctg_end_pos])
     return ctg_on_chr
 
 
-# bam reader with agp
-def bam_read_with_agp(agp, chr_list, bam, long_bin_size, total_bin_count, i):
-    ctg_on_chr = load_agp(agp)
-    chr_len_db, chr_order = get_chr_len(chr_list)
-    ctg_list = sorted(ctg_on_chr)
-    with pysam.AlignmentFile(bam, 'rb') as fin:
-        for line in fin.fetch(contig=ctg_list[i]):
-            if line.is_unmapped or line.mate_is_unmapped:
+# Pieces of bam references placed on chromosomes, sorted by tid and start position on reference, a read on position
+# read_pos of a piece is converted to start_pos + read_pos - ctg_start_pos on forward pieces and
+# end_pos - read_pos + ctg_start_pos on reverse pieces
+class Liftover:
+    def __init__(self, references, pieces, chr_order, bin_offset):
+        chr_index = {chrn: idx for idx, chrn in enumerate(chr_order)}
+        tid_db = {ref: tid for tid, ref in enumerate(references)}
+        piece_list = []
+        for ref, chrn, start_pos, end_pos, direct, ctg_start_pos, ctg_end_pos in pieces:
+            if ref not in tid_db or chrn not in chr_index:
                 continue
-            ctg1 = line.reference_name
-            ctg2 = line.next_reference_name
-            read_pos1 = line.reference_start + 1
-            read_pos2 = line.next_reference_start + 1
+            piece_list.append([tid_db[ref], ctg_start_pos, ctg_end_pos, start_pos, end_pos, direct == '+',
+                               bin_offset[chr_index[chrn]]])
+        piece_list = sorted(piece_list)
+        piece_arr = np.array(piece_list, dtype=np.int64).reshape(-1, 7)
+        self.tid = piece_arr[:, 0]
+        self.ctg_start_pos = piece_arr[:, 1]
+        self.ctg_end_pos = piece_arr[:, 2]
+        self.start_pos = piece_arr[:, 3]
+        self.end_pos = piece_arr[:, 4]
+        self.direct = piece_arr[:, 5].astype(bool)
+        self.bin_offset = piece_arr[:, 6]
+        self.key = (self.tid << 32) | self.ctg_start_pos
+        self.tid_db = tid_db
+
+    @classmethod
+    def from_agp(cls, references, ctg_on_chr, chr_order, bin_offset):
+        pieces = []
+        for ctg in ctg_on_chr:
+            for piece in ctg_on_chr[ctg]:
+                pieces.append([ctg] + piece)
+        return cls(references, pieces, chr_order, bin_offset)
+
+    # references are chromosomes
+    @classmethod
+    def from_chr(cls, references, chr_len_db, chr_order, bin_offset):
+        pieces = []
+        for chrn in chr_order:
+            pieces.append([chrn, chrn, 1, chr_len_db[chrn], '+', 1, 2 ** 31])
+        return cls(references, pieces, chr_order, bin_offset)
+
+    # Convert reference names to ids, names not in references get -1
+    def get_tid(self, refs):
+        return np.array([self.tid_db.get(ref, -1) for ref in refs.tolist()], dtype=np.int64)
+
+    # Convert 0-based positions of reads to bins on whole genome, reads not on any piece get -1
+    def whole_pos(self, tid, pos, long_bin_size):
+        if len(self.key) == 0:
+            return np.full(len(tid), -1, dtype=np.int64)
+        read_pos = pos + 1
+        idx = np.searchsorted(self.key, (tid << 32) | read_pos, side='right') - 1
+        found = idx >= 0
+        idx[~found] = 0
+        found &= (tid >= 0) & (self.tid[idx] == tid) & (read_pos <= self.ctg_end_pos[idx])
+        converted_pos = np.where(self.direct[idx], self.start_pos[idx] + read_pos - self.ctg_start_pos[idx],
+                                 self.end_pos[idx] - read_pos + self.ctg_start_pos[idx])
+        return np.where(found, self.bin_offset[idx] + converted_pos // long_bin_size, -1)
+
+
+# Collect reference ids and 0-based positions of read pairs into fixed size chunks
+def read_chunks(reads, chunk_size=1 << 20):
+    tid1 = np.empty(chunk_size, dtype=np.int64)
+    pos1 = np.empty(chunk_size, dtype=np.int64)
+    tid2 = np.empty(chunk_size, dtype=np.int64)
+    pos2 = np.empty(chunk_size, dtype=np.int64)
+    cnt = 0
+    for line in reads:
+        if line.is_unmapped or line.mate_is_unmapped:
+            continue
+        tid1[cnt] = line.reference_id
+        pos1[cnt] = line.reference_start
+        tid2[cnt] = line.next_reference_id
+        pos2[cnt] = line.next_reference_start
+        cnt += 1
+        if cnt == chunk_size:
+            yield tid1, pos1, tid2, pos2
+            cnt = 0
+    if cnt:
+        yield tid1[: cnt], pos1[: cnt], tid2[: cnt], pos2[: cnt]
+
+
+# Bin a chunk of read pairs
+def bin_chunk(tid1, pos1, tid2, pos2, long_bin_size, total_bin_count):
+    whole_pos1 = shared_liftover.whole_pos(tid1, pos1, long_bin_size)
+    whole_pos2 = shared_liftover.whole_pos(tid2, pos2, long_bin_size)
+    keep = (whole_pos1 >= 0) & (whole_pos1 < total_bin_count) & (whole_pos2 >= 0) & (whole_pos2 < total_bin_count)
+    return count_bin_pairs(whole_pos1[keep], whole_pos2[keep], total_bin_count)
+
+
+# Bin reads chunk by chunk
+def bin_reads(reads, long_bin_size, total_bin_count):
+    counter = BinPairCounter()
+    for tid1, pos1, tid2, pos2 in read_chunks(reads):
+        counter.add(*bin_chunk(tid1, pos1, tid2, pos2, long_bin_size, total_bin_count))
+    return counter.result()
 
-            if ctg1 not in ctg_on_chr or ctg2 not in ctg_on_chr:
-                continue
-            chrn1, ctg_start_pos1, ctg_end_pos1, ctg_direct1 = ctg_on_chr[ctg1]
-            chrn2, ctg_start_pos2, ctg_end_pos2, ctg_direct2 = ctg_on_chr[ctg2]
-            if ctg_direct1 == '+':
-                converted_pos1 = ctg_start_pos1 + read_pos1 - 1
-            else:
-                converted_pos1 = ctg_end_pos1 - read_pos1 + 1
-            if ctg_direct2 == '+':
-                converted_pos2 = ctg_start_pos2 + read_pos2 - 1
-            else:
-                converted_pos2 = ctg_end_pos2 - read_pos2 + 1
-            if chrn1 not in chr_len_db or chrn2 not in chr_len_db:
-                continue
-            pos1_index = int(converted_pos1 / long_bin_size)
-            pos2_index = int(converted_pos2 / long_bin_size)
 
-            chr1_index = chr_order.index(chrn1)
-            chr2_index = chr_order.index(chrn2)
+# Files not end with .bam are pairs files
+def is_pairs(input_file):
+    return not input_file.endswith('.bam')
 
-            bin_offset = np.frombuffer(shared_bin_offset, dtype=ctypes.c_int)
 
-            whole_pos1 = bin_offset[chr1_index] + pos1_index
-            whole_pos2 = bin_offset[chr2_index] + pos2_index
+def open_pairs(pairs_file):
+    if pairs_file == '-':
+        return sys.stdin
+    if pairs_file.endswith('.gz'):
+        return gzip.open(pairs_file, 'rt')
+    return open(pairs_file, 'r')
 
-            read_count_whole_genome = np.frombuffer(shared_read_count_whole_genome,
-                                                    dtype=ctypes.c_double).reshape(total_bin_count, total_bin_count)
-            read_count_whole_genome[whole_pos1][whole_pos2] += 1
-            read_count_whole_genome[whole_pos2][whole_pos1] += 1
 
+# Pairs reader, columns of chr1, pos1, chr2, pos2 are taken from header of 4DN pairs file, or the juicer short format
+# (str1 chr1 pos1 frag1 str2 chr2 pos2 frag2) is used, lines are yielded in blocks and parsed in workers
+def read_pairs_blocks(fin, block_size=1 << 18):
+    columns = [1, 2, 5, 6]
+    block = []
+    for line in fin:
+        if line[0] != '#':
+            block.append(line)
+            break
+        if line.startswith('## pairs format'):
+            columns = [1, 2, 3, 4]
+        elif line.startswith('#columns:'):
+            names = line.split()[1:]
+            columns = [names.index(_) for _ in ['chr1', 'pos1', 'chr2', 'pos2']]
+    block.extend(itertools.islice(fin, block_size - len(block)))
+    while block:
+        yield columns, block
+        block = list(itertools.islice(fin, block_size))
 
-# bam reader without agp
-def bam_read_no_agp(chr_list, bam, long_bin_size, total_bin_count, i):
-    _, chr_order = get_chr_len(chr_list)
+
+# Bin a block of pairs lines, positions in pairs file are 1-based, each pair is counted twice like the two mates of it
+# in bam file
+def bin_pairs(long_bin_size, total_bin_count, block):
+    columns, lines = block
+    pairs = np.loadtxt(lines, dtype=[('chr1', 'O'), ('pos1', np.int64), ('chr2', 'O'), ('pos2', np.int64)],
+                       usecols=columns, ndmin=1, comments=None)
+    keys, counts = bin_chunk(shared_liftover.get_tid(pairs['chr1']), pairs['pos1'] - 1,
+                             shared_liftover.get_tid(pairs['chr2']), pairs['pos2'] - 1, long_bin_size, total_bin_count)
+    return keys, counts * 2
+
+
+# Pairs file is streamed by the parent, at most 2 blocks per thread are waiting, so the memory does not grow with
+# the size of file
+def pairs_read(pairs_file, long_bin_size, total_bin_count, pool, thread):
+    partial_bin_pairs = functools.partial(bin_pairs, long_bin_size, total_bin_count)
+    counter = BinPairCounter()
+    pending = collections.deque()
+    with open_pairs(pairs_file) as fin:
+        for block in read_pairs_blocks(fin):
+            pending.append(pool.apply_async(partial_bin_pairs, (block,)))
+            if len(pending) >= thread * 2:
+                counter.add(*pending.popleft().get())
+    while pending:
+        counter.add(*pending.popleft().get())
+    return counter.result()
+
+
+# Mapped reads and length of each reference
+def get_index_stats(bam):
     with pysam.AlignmentFile(bam, 'rb') as fin:
-        for line in fin.fetch(contig=chr_order[i]):
-            if line.is_unmapped or line.mate_is_unmapped:
-                continue
-            chrn1 = line.reference_name
-            chrn2 = line.next_reference_name
-            if chrn1 not in chr_order or chrn2 not in chr_order:
-                continue
+        mapped_db = {_.contig: _.mapped for _ in fin.get_index_statistics()}
+        ctg_len_db = dict(zip(fin.references, fin.lengths))
+    return mapped_db, ctg_len_db
 
-            read_pos1 = line.reference_start + 1
-            read_pos2 = line.next_reference_start + 1
 
-            pos1_index = int(read_pos1 / long_bin_size)
-            pos2_index = int(read_pos2 / long_bin_size)
+# Split reads into tasks with similar read counts by index statistics of bam, contigs with more reads than a task
+# are split into sub-regions and small contigs are packed together, tasks are sorted by read count descending so
+# the largest ones are dispatched first
+def get_tasks(bam, ctg_list, thread, task_per_thread=4):
+    mapped_db, ctg_len_db = get_index_stats(bam)
+    ctg_stat = sorted([[mapped_db[ctg], ctg] for ctg in set(ctg_list) if mapped_db.get(ctg, 0) > 0], reverse=True)
+    task_size = max(1, sum([_[0] for _ in ctg_stat]) // (thread * task_per_thread))
 
-            chr1_index = chr_order.index(chrn1)
-            chr2_index = chr_order.index(chrn2)
+    tasks = []
+    batch = []
+    batch_size = 0
+    for mapped, ctg in ctg_stat:
+        ctg_len = ctg_len_db[ctg]
+        if mapped > task_size:
+            region_cnt = min(int(np.ceil(mapped * 1.0 / task_size)), ctg_len)
+            step = int(np.ceil(ctg_len * 1.0 / region_cnt))
+            for start_pos in range(0, ctg_len, step):
+                tasks.append([mapped * 1.0 / region_cnt, [[ctg, start_pos, min(start_pos + step, ctg_len)]]])
+        else:
+            batch.append([ctg, 0, ctg_len])
+            batch_size += mapped
+            if batch_size >= task_size:
+                tasks.append([batch_size, batch])
+                batch = []
+                batch_size = 0
+    if batch:
+        tasks.append([batch_size, batch])
+    return [regions for _, regions in sorted(tasks, key=lambda x: -x[0])]
 
-            bin_offset = np.frombuffer(shared_bin_offset, dtype=ctypes.c_int)
 
-            whole_pos1 = bin_offset[chr1_index] + pos1_index
-            whole_pos2 = bin_offset[chr2_index] + pos2_index
-            read_count_whole_genome = np.frombuffer(shared_read_count_whole_genome,
-                                                    dtype=ctypes.c_double).reshape(total_bin_count, total_bin_count)
-            read_count_whole_genome[whole_pos1][whole_pos2] += 1
-            read_count_whole_genome[whole_pos2][whole_pos1] += 1
+# Reads start in region, reads start before the region but overlap it are skipped, they belong to previous region
+def fetch_region(fin, ctg, start_pos, end_pos):
+    for line in fin.fetch(contig=ctg, start=start_pos, stop=end_pos):
+        if line.reference_start >= start_pos:
+            yield line
+
+
+# Read fraction range [lo, hi) of each reference in each round of preview, preview is a fraction of reads or a number
+# of reads on each reference, the fraction is doubled in each round when refining until all reads are read
+def get_preview_rounds(bam_files, preview, refine):
+    mapped_db = collections.Counter()
+    for bam_file in bam_files:
+        mapped_db.update(get_index_stats(bam_file)[0])
+    if preview < 1:
+        fraction_db = {ctg: preview for ctg in mapped_db}
+    else:
+        fraction_db = {ctg: min(1., preview / max(mapped_db[ctg], 1)) for ctg in mapped_db}
+    rounds = []
+    lo_db = {ctg: 0. for ctg in mapped_db}
+    scale = 1
+    while True:
+        hi_db = {ctg: min(1., fraction_db[ctg] * scale) for ctg in mapped_db}
+        rounds.append([lo_db, hi_db])
+        if not refine or all([_ == 1 for _ in hi_db.values()]):
+            return rounds
+        lo_db = hi_db
+        scale *= 2
+
+
+# Windows of regions for preview, reads start in [lo, hi) of each window are read, windows are aligned to the start
+# of references, so different rounds read different reads and all rounds together read all reads
+def sample_regions(regions, window, lo_db, hi_db):
+    sampled = []
+    for ctg, start_pos, end_pos in regions:
+        lo_len = int(round(lo_db[ctg] * window))
+        hi_len = int(round(hi_db[ctg] * window))
+        if lo_len >= hi_len:
+            continue
+        for win_start in range(start_pos // window * window, end_pos, window):
+            sample_start = max(win_start + lo_len, start_pos)
+            sample_end = min(win_start + hi_len, end_pos)
+            if sample_start < sample_end:
+                sampled.append([ctg, sample_start, sample_end])
+    return sampled
+
+
+# bam reader, reads in a list of regions on contigs (with agp) or chromosomes (without agp)
+def bam_read(bam, long_bin_size, total_bin_count, regions):
+    with pysam.AlignmentFile(bam, 'rb') as fin:
+        reads = itertools.chain.from_iterable(fetch_region(fin, *region) for region in regions)
+        return bin_reads(reads, long_bin_size, total_bin_count)
 
 
 # Calc read counts on each bin
-def calc_read_count_per_min_size(chr_list, bam, agp, min_size, thread):
+def calc_read_count_per_min_size(chr_list, bam, agp, min_size, thread, region="", sample=None):
     long_bin_size = min_size
 
-    chr_len_db, chr_order = get_chr_len(chr_list)
+    chr_len_db, chr_order = get_chr_len(chr_list, region)
     bin_offset = [0 for i in range(0, len(chr_order) + 1)]
     bin_count = [0 for i in range(0, len(chr_order) + 1)]
     total_bin_count = 0
@@ -198,53 +732,83 @@ def calc_read_count_per_min_size(chr_list, bam, agp, min_size, thread):
     for i in range(1, len(bin_count)):
         bin_offset[i] = bin_count[i] + bin_offset[i - 1]
 
-    bin_offset_base = multiprocessing.RawArray(ctypes.c_int, np.array(bin_offset))
-    read_count_whole_genome_base = multiprocessing.RawArray(ctypes.c_double, total_bin_count * total_bin_count)
-
-    # because of the hic signal is sparse between chromosomes, means the reads pair read by different process
-    # unlikely locate in same bin, that means different process unlikely write same bin at same time, so we do
-    # not use lock to avoid data write in same bin.
     if agp:
-        ctg_cnt = len(load_agp(agp))
-        if thread > ctg_cnt:
-            time_print("Threads is larger than need, reduce to %d" % ctg_cnt)
-            thread = ctg_cnt
-        partial_bam_read_with_agp = functools.partial(bam_read_with_agp, agp, chr_list, bam,
-                                                      long_bin_size, total_bin_count)
-        pool = multiprocessing.Pool(processes=thread, initializer=init_pool,
-                                    initargs=(bin_offset_base, read_count_whole_genome_base))
-        pool.map(partial_bam_read_with_agp, range(ctg_cnt))
+        ctg_on_chr = load_agp(agp)
+        ctg_list = sorted([ctg for ctg in ctg_on_chr if any([_[0] in chr_len_db for _ in ctg_on_chr[ctg]])])
+    else:
+        ctg_list = chr_order
+    if is_pairs(bam):
+        references = ctg_list
+    else:
+        with pysam.AlignmentFile(bam, 'rb') as fin:
+            references = fin.references
+    if agp:
+        liftover = Liftover.from_agp(references, ctg_on_chr, chr_order, bin_offset)
     else:
-        chr_cnt = len(chr_order)
-        if thread > chr_cnt:
-            time_print("Threads is larger than need, reduce to %d" % chr_cnt)
-            thread = chr_cnt
-        partial_bam_read_no_agp = functools.partial(bam_read_no_agp, chr_list, bam, long_bin_size, total_bin_count)
-        pool = multiprocessing.Pool(processes=thread, initializer=init_pool,
-                                    initargs=(bin_offset_base, read_count_whole_genome_base))
-        pool.map(partial_bam_read_no_agp, range(chr_cnt))
-
-    return np.array(bin_offset), np.array(np.frombuffer(read_count_whole_genome_base,
-                                                        dtype=ctypes.c_double).reshape(total_bin_count,
-                                                                                       total_bin_count))
-
-
-def draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
-                 ratio, chr_order, min_size, cmap, draw_line, draw_block,
-                 line_color):
+        liftover = Liftover.from_chr(references, chr_len_db, chr_order, bin_offset)
+
+    if is_pairs(bam):
+        with multiprocessing.Pool(processes=thread, initializer=init_pool, initargs=(liftover,)) as pool:
+            keys, counts = pairs_read(bam, long_bin_size, total_bin_count, pool, thread)
+        return np.array(bin_offset), SparseMatrix.from_keys(keys, counts, total_bin_count)
+
+    # each task counts bin pairs of its own reads in a private accumulator, and the parent merges the results as
+    # they arrive, so no process writes shared memory and the counts are same with any number of threads.
+    tasks = get_tasks(bam, ctg_list, thread)
+    if sample is not None:
+        tasks = [sample_regions(regions, long_bin_size, *sample) for regions in tasks]
+        tasks = [regions for regions in tasks if regions]
+    task_cnt = len(tasks)
+    if thread > task_cnt:
+        time_print("Threads is larger than need, reduce to %d" % max(task_cnt, 1))
+        thread = max(task_cnt, 1)
+    partial_bam_read = functools.partial(bam_read, bam, long_bin_size, total_bin_count)
+    counter = BinPairCounter()
+    with multiprocessing.Pool(processes=thread, initializer=init_pool, initargs=(liftover,)) as pool:
+        for keys, counts in pool.imap_unordered(partial_bam_read, tasks):
+            counter.add(keys, counts)
+
+    keys, counts = counter.result()
+    return np.array(bin_offset), SparseMatrix.from_keys(keys, counts, total_bin_count)
+
+
+# Init global pyramid for drawing, levels in memory are shared with workers, or each worker opens the h5 file itself
+def init_draw_pool(pyramid, h5_file):
+    global shared_pyramid
+    if pyramid is None:
+        h5_data = h5py.File(h5_file, 'r')
+        pyramid = MatrixPyramid(h5_data['bin_offset_min_size'][:], h5=h5_data)
+    shared_pyramid = pyramid
+
+
+# Draw one figure of one bin size, figure is whole_genome or all_chrs, raster is the image format for raster output
+def draw_heatmap(bin_offset_min_size, chr_order, min_size, cmap, draw_line, draw_block, line_color, raster, frame,
+                 balance, job):
+    ratio, figure = job
+    if figure == 'all_chrs':
+        # ratio is a list of ratios of chromosomes with auto bin size
+        chr_ratios = ratio if isinstance(ratio, list) else [ratio for _ in chr_order]
+        level_db = {_: shared_pyramid.get(_, balance) for _ in set(chr_ratios)}
+        return draw_all_chrs([level_db[_] for _ in chr_ratios], bin_offset_min_size, chr_ratios, chr_order, min_size,
+                             cmap, raster, isinstance(ratio, list))
+    read_count_whole_genome = shared_pyramid.get(ratio, balance)
+    if figure == 'whole_genome' and raster:
+        return draw_whole_genome_raster(read_count_whole_genome, ratio, chr_order, min_size, cmap, draw_line,
+                                        draw_block, line_color, raster, frame)
+    else:
+        return draw_whole_genome(read_count_whole_genome, ratio, chr_order, min_size, cmap, draw_line, draw_block,
+                                 line_color)
+
+
+# read_count_whole_genome is level of ratio in pyramid, bins of each chromosome start from its first bin
+def draw_whole_genome(read_count_whole_genome, ratio, chr_order, min_size, cmap, draw_line, draw_block, line_color):
     bin_size = int(ratio * min_size)
     short_bin_size = long2short(bin_size)
 
-    total_cnt = len(read_count_whole_genome_min_size)
-    ratio_cnt = int(round(total_cnt * 1.0 / ratio + 0.51, 0))
-    plt_cnt = int(total_cnt * 1.0 / ratio)
+    bin_offset = read_count_whole_genome.bin_offset
+    plt_cnt = read_count_whole_genome.size
 
-    data = read_count_whole_genome_min_size
-
-    data = np.pad(data, ((0, ratio_cnt * ratio - total_cnt), (0, ratio_cnt * ratio - total_cnt)), 'constant',
-                  constant_values=0)
-    data = data.reshape(-1, ratio_cnt, ratio).sum(axis=2)
-    data = data.reshape(ratio_cnt, -1, ratio_cnt).sum(axis=1)
+    data = read_count_whole_genome.bin_sum()
 
     fn = "%s_Whole_genome.pdf" % short_bin_size
     cmap = plt.get_cmap(cmap)
@@ -253,7 +817,17 @@ def draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
         hmap = ax.imshow(np.log2(data[: plt_cnt, : plt_cnt]), interpolation='nearest', origin='lower', cmap=cmap,
                          aspect='equal')
 
-    plt.colorbar(mappable=hmap, cax=None, ax=None, shrink=0.5)
+    draw_whole_genome_frame(ax, hmap, bin_offset, plt_cnt, short_bin_size, chr_order, draw_line, draw_block,
+                            line_color)
+    plt.savefig(fn, bbox_inches='tight', dpi=200)
+    plt.close('all')
+    return fn
+
+
+# colorbar, labels and chromosome lines or blocks of whole genome heatmap
+def draw_whole_genome_frame(ax, hmap, bin_offset, plt_cnt, short_bin_size, chr_order, draw_line, draw_block,
+                            line_color):
+    plt.colorbar(mappable=hmap, cax=None, ax=ax, shrink=0.5)
     plt.tick_params(labelsize=6)
     for ticks in ax.get_xticklabels():
         ticks.set_rotation(90)
@@ -266,8 +840,8 @@ def draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
         x_ticks = []
         y_ticks = []
         for _ in chr_order:
-            sr = bin_offset_min_size[idx - 1] * 1. / ratio
-            er = bin_offset_min_size[idx] * 1. / ratio
+            sr = bin_offset[idx - 1] * 1.
+            er = bin_offset[idx] * 1.
             mr = (sr + er) / 2.
             if draw_line:
                 plt.plot((sr, sr), (0, plt_cnt), color=line_color, linestyle=':', lw=.5)
@@ -291,27 +865,113 @@ def draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
         plt.xticks([])
         plt.yticks([])
     plt.title(title, y=1.01, fontsize=12)
-    plt.savefig(fn, bbox_inches='tight', dpi=200)
-    plt.close('all')
 
+
+# Write whole genome heatmap as raster image directly, one pixel per bin, log2 of read counts are mapped to a palette
+# of cmap, non-zero bins are read twice from the sparse matrix, once for the range of colors and once for painting,
+# bins without reads are white, and chromosome lines or blocks are dotted pixels, so the memory is a byte per bin and
+# one row block, a small pdf with labels and a thumbnail is written if frame is set
+def draw_whole_genome_raster(read_count_whole_genome, ratio, chr_order, min_size, cmap, draw_line, draw_block,
+                             line_color, raster, frame):
+    bin_size = int(ratio * min_size)
+    short_bin_size = long2short(bin_size)
+
+    bin_offset = read_count_whole_genome.bin_offset
+    plt_cnt = read_count_whole_genome.size
+
+    vmin = np.inf
+    vmax = -np.inf
+    for rows, cols, sums in read_count_whole_genome.iter_sums():
+        # pairs on diagonal are doubled like the sum of matrix and its transpose
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sums = np.log2(np.where(rows == cols, sums * 2, sums))
+        sums = sums[np.isfinite(sums)]
+        if len(sums):
+            vmin = min(vmin, sums.min())
+            vmax = max(vmax, sums.max())
+    if vmin > vmax:
+        vmin, vmax = 0., 1.
+
+    # 0-253 for cmap, 254 for bins without reads, 255 for lines, row 0 of image is the top of heatmap
+    color_cnt = 254
+    scale = (color_cnt - 1) / max(vmax - vmin, 1e-9)
+    img = np.full((plt_cnt, plt_cnt), color_cnt, dtype=np.uint8)
+    for rows, cols, sums in read_count_whole_genome.iter_sums():
+        # pairs on diagonal are doubled like the sum of matrix and its transpose
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sums = np.log2(np.where(rows == cols, sums * 2, sums))
+        finite = np.isfinite(sums)
+        rows = rows[finite]
+        cols = cols[finite]
+        colors = np.round((sums[finite] - vmin) * scale).astype(np.uint8)
+        img[plt_cnt - 1 - rows, cols] = colors
+        img[plt_cnt - 1 - cols, rows] = colors
+
+    if draw_line or draw_block:
+        dots = np.arange(plt_cnt)
+        dots = dots[dots % 4 < 2]
+        for idx in range(1, len(bin_offset)):
+            sr = bin_offset[idx - 1]
+            er = bin_offset[idx]
+            if draw_line:
+                seg = dots
+            else:
+                seg = dots[(dots >= sr) & (dots < er)]
+            for pos in (sr, er):
+                pos = min(pos, plt_cnt - 1)
+                img[plt_cnt - 1 - pos, seg] = color_cnt + 1
+                img[plt_cnt - 1 - seg, pos] = color_cnt + 1
+
+    cmap = plt.get_cmap(cmap)
+    palette = np.zeros((color_cnt + 2, 3), dtype=np.uint8)
+    palette[: color_cnt] = np.round(cmap(np.linspace(0, 1, color_cnt))[:, :3] * 255)
+    palette[color_cnt] = 255
+    palette[color_cnt + 1] = np.round(np.array(mpl.colors.to_rgb(line_color)) * 255)
+
+    fn = "%s_Whole_genome.%s" % (short_bin_size, raster)
+    im = Image.fromarray(img)
+    im.putpalette(palette.flatten().tolist())
+    if raster == 'tiff':
+        im.save(fn, compression='tiff_deflate')
+    else:
+        im.save(fn)
+
+    if frame:
+        step = max(1, int(np.ceil(plt_cnt / 1000.)))
+        ax = plt.gca()
+        ax.imshow(palette[img[::step, ::step]], interpolation='nearest', extent=(0, plt_cnt, 0, plt_cnt),
+                  aspect='equal')
+        hmap = mpl.cm.ScalarMappable(norm=mpl.colors.Normalize(vmin=vmin, vmax=vmax), cmap=cmap)
+        draw_whole_genome_frame(ax, hmap, bin_offset, plt_cnt, short_bin_size, chr_order, draw_line, draw_block,
+                                line_color)
+        plt.savefig("%s_Whole_genome.frame.pdf" % short_bin_size, bbox_inches='tight', dpi=200)
+        plt.close('all')
+    return fn
+
+
+# chr_levels are levels of ratios of chromosomes in pyramid, bins of each chromosome start from its first bin
+def draw_all_chrs(chr_levels, bin_offset_min_size, chr_ratios, chr_order, min_size, cmap, raster, auto):
+    if auto:
+        short_bin_size = 'auto'
+    else:
+        short_bin_size = long2short(int(chr_ratios[0] * min_size))
+
+    cmap = plt.get_cmap(cmap)
     chr_cnt = len(chr_order)
     row_cnt = int(round(np.sqrt(chr_cnt) + 0.51))
     col_cnt = int(round(chr_cnt * 1.0 / row_cnt + 0.51))
-    all_fn = '%s_all_chrs.pdf' % short_bin_size
+    all_fn = '%s_all_chrs.%s' % (short_bin_size, raster if raster else 'pdf')
     plt.figure(figsize=(col_cnt * 2, row_cnt * 2))
     idx = 1
     for chrn in chr_order:
-        sr = bin_offset_min_size[idx - 1]
-        er = bin_offset_min_size[idx]
-        sub_data = read_count_whole_genome_min_size[sr: er, sr: er]
-        total_cnt = len(sub_data)
-        ratio_cnt = int(round(total_cnt * 1.0 / ratio + 0.51, 0))
+        read_count_whole_genome = chr_levels[idx - 1]
+        ratio = chr_ratios[idx - 1]
+        sr = read_count_whole_genome.bin_offset[idx - 1]
+        er = read_count_whole_genome.bin_offset[idx]
+        total_cnt = bin_offset_min_size[idx] - bin_offset_min_size[idx - 1]
         plt_cnt = int(total_cnt * 1.0 / ratio)
 
-        sub_data = np.pad(sub_data, ((0, ratio_cnt * ratio - total_cnt), (0, ratio_cnt * ratio - total_cnt)),
-                          'constant', constant_values=0)
-        sub_data = sub_data.reshape(-1, ratio_cnt, ratio).sum(axis=2)
-        sub_data = sub_data.reshape(ratio_cnt, -1, ratio_cnt).sum(axis=1)
+        sub_data = read_count_whole_genome.bin_sum(sr, er)
 
         plt.subplot(row_cnt, col_cnt, idx)
         ax = plt.gca()
@@ -320,17 +980,78 @@ def draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
                              cmap=cmap, aspect='equal')
         plt.colorbar(mappable=hmap, cax=None, ax=None, shrink=0.5)
         plt.tick_params(labelsize=5)
-        plt.title(chrn)
+        if auto:
+            plt.title("%s (%s)" % (chrn, long2short(int(ratio * min_size))))
+        else:
+            plt.title(chrn)
         idx += 1
 
     plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=0.5, hspace=0.5)
     plt.savefig(all_fn, bbox_inches='tight', dpi=200)
     plt.close('all')
+    return all_fn
+
+
+# Balance pyramid in memory, bin sizes for drawing are added to it so each of them is balanced, or balance pyramid in
+# h5 file, weights are written to h5 file
+def balance_pyramid(pyramid, h5_file, bin_ratio):
+    time_print("Balancing matrix")
+    if pyramid is None:
+        with h5py.File(h5_file, 'r+') as h5_data:
+            h5_pyramid = MatrixPyramid(h5_data['bin_offset_min_size'][:], h5=h5_data)
+            h5_pyramid.balance()
+            h5_pyramid.save_weights(h5_data)
+        return
+    pyramid.build([_ for _ in set(bin_ratio) if _ not in pyramid.levels])
+    pyramid.balance()
+    if h5_file != "":
+        with h5py.File(h5_file, 'r+') as h5_data:
+            pyramid.save_weights(h5_data)
+
+
+# Smallest ratios whose heatmaps fit in pixel budget, for whole genome heatmap and each chromosome subplot, bins of
+# each chromosome start from its first bin, so whole genome heatmap has sum of ceil(bin count / ratio) bins
+def get_auto_ratios(chr_len_db, chr_order, min_size, pixels, panel_pixels):
+    bin_count = np.array([int(round((chr_len_db[chrn] * 1.0 / min_size + 0.51))) for chrn in chr_order])
+    chr_ratios = [max(1, int(np.ceil(_ * 1.0 / panel_pixels))) for _ in bin_count]
+    # each chromosome keeps at least one bin, so the budget cannot be met with more chromosomes than pixels
+    if len(chr_order) > pixels:
+        time_print("Warning: %d chromosomes exceed pixel budget %d, one bin for each chromosome in whole genome "
+                   "heatmap" % (len(chr_order), pixels))
+        return int(bin_count.max()), chr_ratios
+    ratio = max(1, int(np.ceil(bin_count.sum() * 1.0 / pixels)))
+    while ((bin_count + ratio - 1) // ratio).sum() > pixels:
+        ratio += 1
+    return ratio, chr_ratios
+
+
+# Draw heatmaps of all bin sizes, with auto bin size, chr_ratios are ratios of chromosome subplots and bin_ratio
+# only contains ratio of whole genome heatmap
+def draw_heatmaps(pyramid, h5_file, bin_offset_min_size, chr_order, min_size, bin_ratio, bin_list, cmap, draw_line,
+                  draw_block, line_color, raster, frame, balance, thread, chr_ratios=None):
+    if balance:
+        balance_pyramid(pyramid, h5_file, bin_ratio)
+    # each figure of each bin size is drawn in a process, smaller bin sizes are more expensive, so they go first
+    jobs = []
+    for ratio in sorted(set(bin_ratio)):
+        jobs.append([ratio, 'whole_genome'])
+        if chr_ratios is None:
+            jobs.append([ratio, 'all_chrs'])
+    if chr_ratios is not None:
+        jobs.append([chr_ratios, 'all_chrs'])
+    time_print("Drawing with bin size %s" % ','.join(bin_list))
+    partial_draw_heatmap = functools.partial(draw_heatmap, bin_offset_min_size, chr_order, min_size, cmap,
+                                             draw_line, draw_block, line_color, raster, frame, balance)
+    # workers are forked so the pyramid in memory is shared with them instead of being pickled into each of them
+    with multiprocessing.get_context('fork').Pool(processes=max(min(thread, len(jobs)), 1),
+                                                  initializer=init_draw_pool, initargs=(pyramid, h5_file)) as pool:
+        for fn in pool.imap_unordered(partial_draw_heatmap, jobs):
+            time_print("\t%s finished" % fn)
 
 
 def ALLHiC_plot(bam, agp, chr_list, h5_file, minsize, binsize, cmap, draw_line, draw_block,
-                line_color, out_dir, thread):
-    bam_file = os.path.abspath(bam)
+                line_color, out_dir, thread, raster, frame, region, append, preview, refine, balance, pixels):
+    bam_files = [_ if _ == '-' else os.path.abspath(_) for _ in bam.split(',')]
     if agp:
         agp_file = os.path.abspath(agp)
     else:
@@ -347,35 +1068,120 @@ def ALLHiC_plot(bam, agp, chr_list, h5_file, minsize, binsize, cmap, draw_line,
 
     bin_list = binsize.split(',')
     bin_ratio = []
-    for bin_size in bin_list:
-        long_bin_size = short2long(bin_size)
-        bin_ratio.append(int(round(long_bin_size / min_size + 0.01, 0)))
+    if binsize != 'auto':
+        for bin_size in bin_list:
+            long_bin_size = short2long(bin_size)
+            bin_ratio.append(int(round(long_bin_size / min_size + 0.01, 0)))
 
     time_print("Step1: Get chromosome length")
-    chr_len_db, chr_order = get_chr_len(chr_list)
+    chr_len_db, chr_order = get_chr_len(chr_list, region)
+    if region:
+        missing_chrs = set(region.split(',')) - set(chr_order)
+        if missing_chrs:
+            time_print("Fatal: %s not found in chromosome list" % ','.join(sorted(missing_chrs)))
+            sys.exit(-1)
+    if agp_file:
+        placed_chrs = set([piece[0] for pieces in load_agp(agp_file).values() for piece in pieces])
+        empty_chrs = [chrn for chrn in chr_order if chrn not in placed_chrs]
+        if len(empty_chrs) == len(chr_order):
+            time_print("Fatal: no contigs placed on chromosomes in agp file, check chromosome names")
+            sys.exit(-1)
+        if empty_chrs:
+            time_print("Warning: no contigs placed on %s in agp file" % ','.join(empty_chrs))
+    chr_ratios = None
+    if binsize == 'auto':
+        pixel_list = pixels.split(',')
+        if len(pixel_list) != 2 or not all([_.isdigit() and int(_) > 0 for _ in pixel_list]):
+            time_print("Fatal: pixels must be two positive integers separated by comma, like 1000,400")
+            sys.exit(-1)
+        pixels, panel_pixels = [int(_) for _ in pixel_list]
+        ratio, chr_ratios = get_auto_ratios(chr_len_db, chr_order, min_size, pixels, panel_pixels)
+        bin_ratio = [ratio]
+        bin_list = [long2short(ratio * min_size)]
+        time_print("Auto bin size: %s for whole genome, %s for chromosomes" % (
+            bin_list[0], ','.join([long2short(_ * min_size) for _ in chr_ratios])))
 
     time_print("Step2: Get signal matrix")
-    if h5_file != "" and os.path.exists(h5_file):
-        h5_data = h5py.File(h5_file, 'r')
-        bin_offset_min_size = h5_data['bin_offset_min_size']
-        read_count_whole_genome_min_size = h5_data['read_count_whole_genome_min_size']
+    if append and h5_file == "":
+        time_print("Fatal: h5 file is required for appending")
+        sys.exit(-1)
+    h5_info = get_h5_info(chr_order, agp_file, min_size, bam_files)
+    pyramid = None
+    new_bam_files = []
+    if preview:
+        if preview < 0:
+            time_print("Fatal: preview must be a fraction of reads (<1) or a number of reads (>=1)")
+            sys.exit(-1)
+        if append or any([is_pairs(_) for _ in bam_files]):
+            time_print("Fatal: preview only works with bam files and cannot be appended")
+            sys.exit(-1)
+        if h5_file != "" and os.path.exists(h5_file):
+            time_print("Fatal: h5 file exists, remove it or run without preview")
+            sys.exit(-1)
+        # each round reads reads not read before and adds them to the matrix, heatmaps of the last round are drawn
+        # in Step3
+        rounds = get_preview_rounds(bam_files, preview, refine)
+        matrices = []
+        for idx, sample in enumerate(rounds):
+            time_print("Preview round %d of %d" % (idx + 1, len(rounds)))
+            for bam_file in bam_files:
+                bin_offset_min_size, read_count_whole_genome_min_size = calc_read_count_per_min_size(
+                    chr_list, bam_file, agp_file, min_size, thread, region, sample)
+                matrices.append(read_count_whole_genome_min_size)
+            if len(matrices) > 1:
+                matrices = [SparseMatrix.merge(matrices)]
+            pyramid = MatrixPyramid(bin_offset_min_size, matrix=matrices[0])
+            if h5_file != "":
+                h5_info['preview'] = not all([_ == 1 for _ in sample[1].values()])
+                save_h5(h5_file, pyramid, bin_ratio, h5_info)
+            if idx < len(rounds) - 1:
+                draw_heatmaps(pyramid, h5_file, bin_offset_min_size, chr_order, min_size, bin_ratio, bin_list, cmap,
+                              draw_line, draw_block, line_color, raster, frame, balance, thread, chr_ratios)
+    elif h5_file != "" and os.path.exists(h5_file):
+        with h5py.File(h5_file, 'r') as h5_data:
+            bin_offset_min_size = h5_data['bin_offset_min_size'][:]
+            check_h5_info(h5_data, h5_info)
+            if h5_data.attrs.get('preview', False):
+                time_print("Warning: h5 file is a preview with part of reads")
+            if append:
+                if 'bams' not in h5_data.attrs or h5_data.attrs.get('preview', False):
+                    time_print("Fatal: no record of bam files in h5 file or it is a preview, it cannot be appended")
+                    sys.exit(-1)
+                h5_info['bams'] = [str(_) for _ in h5_data.attrs['bams']]
+                new_bam_files = [_ for _ in bam_files if _ == '-' or _ not in h5_info['bams']]
+                if not new_bam_files:
+                    time_print("All bam files are already in h5 file")
+            if new_bam_files:
+                matrices = [load_matrix(h5_data, 'read_count_whole_genome_min_size_sparse')]
+                for bam_file in new_bam_files:
+                    time_print("Appending %s" % bam_file)
+                    matrices.append(calc_read_count_per_min_size(chr_list, bam_file, agp_file, min_size, thread,
+                                                                 region)[1])
+                    if bam_file != '-':
+                        h5_info['bams'].append(bam_file)
+                pyramid = MatrixPyramid(bin_offset_min_size, matrix=SparseMatrix.merge(matrices))
+            elif 'read_count_whole_genome_min_size' in h5_data:
+                pyramid = MatrixPyramid(bin_offset_min_size,
+                                        matrix=SparseMatrix.from_dense(h5_data['read_count_whole_genome_min_size']))
+        if new_bam_files:
+            save_h5(h5_file, pyramid, bin_ratio, h5_info)
     else:
-        bin_offset_min_size, read_count_whole_genome_min_size = calc_read_count_per_min_size(chr_list, bam_file,
-                                                                                             agp_file, min_size,
-                                                                                             thread)
+        matrices = []
+        for bam_file in bam_files:
+            time_print("Reading %s" % bam_file)
+            bin_offset_min_size, read_count_whole_genome_min_size = calc_read_count_per_min_size(chr_list, bam_file,
+                                                                                                 agp_file, min_size,
+                                                                                                 thread, region)
+            matrices.append(read_count_whole_genome_min_size)
+        if len(matrices) > 1:
+            read_count_whole_genome_min_size = SparseMatrix.merge(matrices)
+        pyramid = MatrixPyramid(bin_offset_min_size, matrix=read_count_whole_genome_min_size)
         if h5_file != "":
-            h5 = h5py.File(h5_file, 'w')
-            h5.create_dataset('bin_offset_min_size', data=bin_offset_min_size)
-            h5.create_dataset('read_count_whole_genome_min_size', data=read_count_whole_genome_min_size)
+            save_h5(h5_file, pyramid, bin_ratio, h5_info)
 
     time_print("Step3: Draw heatmap")
-
-    for i in range(0, len(bin_ratio)):
-        ratio = bin_ratio[i]
-        time_print("Drawing with bin size %s" % bin_list[i])
-        draw_heatmap(read_count_whole_genome_min_size, bin_offset_min_size,
-                     ratio, chr_order, min_size, cmap, draw_line, draw_block,
-                     line_color)
+    draw_heatmaps(pyramid, h5_file, bin_offset_min_size, chr_order, min_size, bin_ratio, bin_list, cmap, draw_line,
+                  draw_block, line_color, raster, frame, balance, thread, chr_ratios)
     os.chdir('..')
     time_print("Success")
 
@@ -394,4 +1200,13 @@ if __name__ == "__main__":
     draw_block = opts.block
     line_color = opts.linecolor
     thread = opts.thread
-    ALLHiC_plot(bam, agp, chr_list, h5_file, minsize, binsize, cmap, draw_line, draw_block, line_color, out_dir, thread)
+    raster = opts.raster
+    frame = opts.frame
+    region = opts.region
+    append = opts.append
+    preview = opts.preview
+    refine = opts.refine
+    balance = opts.balance
+    pixels = opts.pixels
+    ALLHiC_plot(bam, agp, chr_list, h5_file, minsize, binsize, cmap, draw_line, draw_block, line_color, out_dir, thread,
+                raster, frame, region, append, preview, refine, balance, pixels)
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 import argparse
+import heapq
+import multiprocessing
 from genericpath import exists, getctime
 import os
 import re
 from sys import path
 import pysam
+import numpy as np
 import time
 
 
@@ -24,6 +27,7 @@ def get_opts():
     group.add_argument('-j', '--jcvi', help="CDS file for jcvi, bed file with same prefix must exist in the same position", required=True)
     group.add_argument('-e', '--exclude', help="cluster which need no rescue, default=\"\", split by comma", default="")
     group.add_argument('-w', '--workdir', help="Work directory, default=wrkdir", default="wrkdir")
+    group.add_argument('-t', '--thread', help="Threads for initial scoring of contigs, default=1", type=int, default=1)
     return group.parse_args()
 
 
@@ -96,8 +100,83 @@ def convert_query_db(qry_db, anchor_db):
     return new_qry_db
 
 
-def get_ovlp(qry_set1, qry_set2):
-    return len(qry_set1.intersection(qry_set2))
+# Anchor genes are converted to integer ids, each contig is stored as an array of gene ids
+def get_gene_ids(qry_db):
+    gene_idx = {}
+    ctg_genes = {}
+    for ctg in qry_db:
+        ctg_genes[ctg] = np.array(sorted([gene_idx.setdefault(gn, len(gene_idx)) for gn in qry_db[ctg]]), dtype=np.int64)
+    return ctg_genes, len(gene_idx)
+
+
+# Overlap of a contig with a cluster, clu_mask is a boolean matrix of clusters x genes
+def get_ovlp(genes, clu_mask, cid):
+    return int(np.count_nonzero(clu_mask[cid, genes]))
+
+
+def init_scoring(clu_mask, gene_offset, gene_list):
+    global scoring_data
+    scoring_data = [clu_mask, gene_offset, gene_list]
+
+
+# Overlaps of pairs of contig and cluster, genes of contigs are stored in CSR format with gene_offset and gene_list
+def score_pairs(pairs):
+    clu_mask, gene_offset, gene_list = scoring_data
+    rows, clus = pairs
+    gene_counts = gene_offset[rows+1]-gene_offset[rows]
+    pair_idx = np.repeat(np.arange(len(rows)), gene_counts)
+    gene_pos = np.arange(len(pair_idx))+np.repeat(gene_offset[rows]-np.cumsum(gene_counts)+gene_counts, gene_counts)
+    hits = clu_mask[clus[pair_idx], gene_list[gene_pos]]
+    return np.bincount(pair_idx, weights=hits, minlength=len(rows)).astype(np.int64)
+
+
+# Initial overlaps of all signal edges, each pair of contig and cluster is scored once, pairs are split into chunks
+# and scored in a process pool when threads > 1
+def get_init_ovlps(sig_offset, sig_clus, gene_offset, gene_list, clu_mask, threads, chunk_size=1<<16):
+    ovlps = np.zeros(len(sig_clus), dtype=np.int64)
+    if len(sig_clus) == 0:
+        return ovlps
+    clu_count = clu_mask.shape[0]
+    rows = np.repeat(np.arange(len(sig_offset)-1), np.diff(sig_offset))
+    keys, inverse = np.unique(rows*clu_count+sig_clus, return_inverse=True)
+    pair_rows = keys//clu_count
+    pair_clus = keys%clu_count
+    pair_ovlps = np.zeros(len(keys), dtype=np.int64)
+    # contigs without anchor genes always have 0 overlap
+    sel = np.where(gene_offset[pair_rows+1] > gene_offset[pair_rows])[0]
+    chunks = [[pair_rows[sel[i: i+chunk_size]], pair_clus[sel[i: i+chunk_size]]] for i in range(0, len(sel), chunk_size)]
+    if threads > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(processes=min(threads, len(chunks)), initializer=init_scoring, initargs=(clu_mask, gene_offset, gene_list)) as pool:
+            res = pool.map(score_pairs, chunks)
+    else:
+        init_scoring(clu_mask, gene_offset, gene_list)
+        res = [score_pairs(chunk) for chunk in chunks]
+    if res:
+        pair_ovlps[sel] = np.concatenate(res)
+    ovlps[:] = pair_ovlps[inverse]
+    return ovlps
+
+
+# Pop the best edge of a contig from heap of [ovlp, -sig, edge], the order is same as sorting all edges, edges of
+# clusters updated after initial scoring are re-scored when they are popped, because overlaps never decrease, a
+# re-scored edge can only move backward. The first edge not in excluded clusters is chosen, or the last one if all
+# clusters are excluded
+def get_best_match(score_heap, genes, sig_clus, clu_mask, clu_updated, clu_names, exclude_set):
+    heapq.heapify(score_heap)
+    rescored = {}
+    best_match = None
+    while score_heap:
+        ovlp, neg_sig, i = heapq.heappop(score_heap)
+        cid = sig_clus[i]
+        if clu_updated[cid] and cid not in rescored:
+            rescored[cid] = get_ovlp(genes, clu_mask, cid)
+        if cid in rescored and rescored[cid] != ovlp:
+            heapq.heappush(score_heap, [rescored[cid], neg_sig, i])
+            continue
+        best_match = [ovlp, -neg_sig, clu_names[cid], cid]
+        if best_match[2] not in exclude_set:
+            break
+    return best_match
 
 
 def get_clusters(clu):
@@ -116,28 +195,88 @@ def get_clusters(clu):
     return clu_db, clu_ctgs
 
 
-def get_hic_signal(bam):
-    signals = {}
+def read_bam_chunks(fin, chunk_size=1<<20):
+    tid1 = np.empty(chunk_size, dtype=np.int64)
+    tid2 = np.empty(chunk_size, dtype=np.int64)
+    pos1 = np.empty(chunk_size, dtype=np.int64)
+    pos2 = np.empty(chunk_size, dtype=np.int64)
+    cnt = 0
+    for line in fin:
+        tid1[cnt] = line.reference_id
+        tid2[cnt] = line.next_reference_id
+        pos1[cnt] = line.reference_start
+        pos2[cnt] = line.next_reference_start
+        cnt += 1
+        if cnt == chunk_size:
+            yield tid1, tid2, pos1, pos2
+            cnt = 0
+    if cnt:
+        yield tid1[:cnt], tid2[:cnt], pos1[:cnt], pos2[:cnt]
+
+
+def merge_signal(keys_list, counts_list, first_list):
+    if not keys_list:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys, inverse = np.unique(np.concatenate(keys_list), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts_list), minlength=len(keys)).astype(np.int64)
+    first = np.full(len(keys), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, inverse, np.concatenate(first_list))
+    return keys, counts, first
+
+
+# Signals of chunks are stacked, the top two are merged while the top one is not smaller than half of the one below,
+# so a big table built from early chunks is not rebuilt for every small chunk after it
+def add_signal(keys_list, counts_list, first_list, keys, counts, first):
+    keys_list.append(keys)
+    counts_list.append(counts)
+    first_list.append(first)
+    while len(keys_list) > 1 and len(keys_list[-1])*2 >= len(keys_list[-2]):
+        keys, counts, first = merge_signal(keys_list[-2:], counts_list[-2:], first_list[-2:])
+        keys_list[-2:] = [keys]
+        counts_list[-2:] = [counts]
+        first_list[-2:] = [first]
+
+
+# Only signals between unclustered contigs and clustered contigs are counted, keys are rem_id*clu_count+clu_id,
+# the order of first read of each pair is kept for breaking ties like the order of reading bam
+def get_hic_signal(bam, remain_ctgs, clu_ctgs):
+    remain_idx = {ctg: i for i, ctg in enumerate(remain_ctgs)}
+    clu_list = list(clu_ctgs)
+    clu_idx = {ctg: i for i, ctg in enumerate(clu_list)}
+    clu_count = len(clu_list)
+
+    keys_list = []
+    counts_list = []
+    first_list = []
+    read_offset = 0
     with pysam.AlignmentFile(bam, 'rb') as fin:
-        for line in fin:
-            ctg1 = line.reference_name
-            pos1 = line.reference_start
-            ctg2 = line.next_reference_name
-            pos2 = line.next_reference_start
-            if pos1==-1 or pos2==-1:
+        # the last one is for reads with reference id -1
+        rem_ref = np.array([remain_idx.get(ref, -1) for ref in fin.references]+[-1], dtype=np.int64)
+        clu_ref = np.array([clu_idx.get(ref, -1) for ref in fin.references]+[-1], dtype=np.int64)
+        for tid1, tid2, pos1, pos2 in read_bam_chunks(fin):
+            read_order = np.arange(read_offset, read_offset+len(tid1), dtype=np.int64)
+            read_offset += len(tid1)
+            valid = (pos1 != -1) & (pos2 != -1)
+            rem1 = rem_ref[tid1]
+            rem2 = rem_ref[tid2]
+            clu1 = clu_ref[tid1]
+            clu2 = clu_ref[tid2]
+            sel1 = valid & (rem1 != -1) & (clu2 != -1)
+            sel2 = valid & (rem2 != -1) & (clu1 != -1)
+            keys = np.concatenate([rem1[sel1]*clu_count+clu2[sel1], rem2[sel2]*clu_count+clu1[sel2]])
+            if len(keys) == 0:
                 continue
-            if ctg1 not in signals:
-                signals[ctg1] = {}
-            if ctg2 not in signals[ctg1]:
-                signals[ctg1][ctg2] = 0
-            signals[ctg1][ctg2] += 1
+            first = np.concatenate([read_order[sel1], read_order[sel2]])
+            keys, counts, first = merge_signal([keys], [np.ones(len(keys), dtype=np.int64)], [first])
+            add_signal(keys_list, counts_list, first_list, keys, counts, first)
 
-            if ctg2 not in signals:
-                signals[ctg2] = {}
-            if ctg1 not in signals[ctg2]:
-                signals[ctg2][ctg1] = 0
-            signals[ctg2][ctg1] += 1
-    return signals
+    keys, counts, first = merge_signal(keys_list, counts_list, first_list)
+    rem_ids = keys//max(clu_count, 1)
+    order = np.lexsort((first, rem_ids))
+    sig_offset = np.searchsorted(rem_ids[order], np.arange(len(remain_ctgs)+1))
+    sig_ctgs = keys[order]%max(clu_count, 1)
+    sig_counts = counts[order]
+    return sig_offset, sig_ctgs, sig_counts, clu_list
 
 
 def get_counts(counts):
@@ -154,7 +293,7 @@ def get_counts(counts):
     return header, counts_db
 
 
-def ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk):
+def ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk, threads):
     if not os.path.exists(wrk):
         os.mkdir(wrk)
     
@@ -197,13 +336,16 @@ def ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk):
 
     time_print("Loading clusters")
     clu_db, clu_ctgs = get_clusters(clu)
-    clu_set = {}
+    ctg_genes, gene_count = get_gene_ids(qry_db)
+    empty_genes = np.zeros(0, dtype=np.int64)
+    clu_names = list(clu_db)
+    clu_idx = {chrn: i for i, chrn in enumerate(clu_names)}
+    clu_mask = np.zeros((len(clu_names), gene_count), dtype=bool)
     for chrn in clu_db:
-        clu_set[chrn] = set()
         for ctg in clu_db[chrn]:
-            if ctg not in qry_db:
+            if ctg not in ctg_genes:
                 continue
-            clu_set[chrn] = clu_set[chrn].union(qry_db[ctg])
+            clu_mask[clu_idx[chrn], ctg_genes[ctg]] = True
     
     remain_ctgs = []
     ctg_db = read_fasta(ref)
@@ -213,36 +355,33 @@ def ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk):
             remain_ctgs.append([ctg, len(ctg_db[ctg])])
     
     time_print("Loading HiC signals")
-    signal_db = get_hic_signal(bam)
+    sig_offset, sig_ctgs, sig_counts, clu_list = get_hic_signal(bam, [ctg for ctg, _ in remain_ctgs], clu_ctgs)
+    sig_clus = np.array([clu_idx[clu_ctgs[ctg]] for ctg in clu_list], dtype=np.int64)[sig_ctgs]
+    gene_offset = np.zeros(len(remain_ctgs)+1, dtype=np.int64)
+    gene_offset[1:] = np.cumsum([len(ctg_genes.get(ctg, empty_genes)) for ctg, _ in remain_ctgs])
+    gene_list = np.concatenate([empty_genes]+[ctg_genes.get(ctg, empty_genes) for ctg, _ in remain_ctgs])
+
+    time_print("Scoring contigs")
+    sig_ovlps = get_init_ovlps(sig_offset, sig_clus, gene_offset, gene_list, clu_mask, threads)
+    clu_updated = np.zeros(len(clu_names), dtype=bool)
 
     time_print("Get best matches")
-    for ctg, ctgl in sorted(remain_ctgs, key=lambda x: x[1], reverse=True):
-        score_list = []
-        if ctg not in signal_db:
-            continue
-        for ctg2 in signal_db[ctg]:
-            if ctg2 not in clu_ctgs:
-                continue
-            sig = signal_db[ctg][ctg2]
-            ovlp = 0
-            chrn = clu_ctgs[ctg2]
-            if ctg in qry_db:
-                ovlp = get_ovlp(qry_db[ctg], clu_set[chrn])
-            score_list.append([ovlp, sig, chrn])
-        if len(score_list)==0:
+    for idx, (ctg, ctgl) in sorted(enumerate(remain_ctgs), key=lambda x: x[1][1], reverse=True):
+        sp = sig_offset[idx]
+        ep = sig_offset[idx+1]
+        if sp == ep:
             continue
-        for best_match in sorted(score_list, key=lambda x: [x[0], -x[1]]):
-            if best_match[2] in exclude_set:
-                continue
-            else:
-                break
-        
+        genes = gene_list[gene_offset[idx]: gene_offset[idx+1]]
+        score_heap = [[int(ovlp), -int(sig), i] for i, ovlp, sig in zip(range(sp, ep), sig_ovlps[sp: ep], sig_counts[sp: ep])]
+        best_match = get_best_match(score_heap, genes, sig_clus, clu_mask, clu_updated, clu_names, exclude_set)
+
         if best_match[1] < 10:
             continue
         time_print("\t%s matched %s, sig: %d, ovlp: %d"%(ctg, best_match[2], best_match[1], best_match[0]))
         clu_db[best_match[2]].append(ctg)
-        if ctg in qry_db:
-            clu_set[best_match[2]] = clu_set[best_match[2]].union(qry_db[ctg])
+        if len(genes):
+            clu_mask[best_match[3], genes] = True
+            clu_updated[best_match[3]] = True
     
     time_print("Writing new groups")
     header, counts_db = get_counts(counts)
@@ -267,4 +406,5 @@ if __name__ == "__main__":
     jprex = '.'.join(jprex.split('.')[:-1])
     exclude = opts.exclude
     wrk = opts.workdir
-    ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk)
+    threads = opts.thread
+    ALLHiC_rescue(ref, bam, clu, counts, gff3, jprex, exclude, wrk, threads)